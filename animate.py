@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains a renderer of animations: the ratio and the vertexes of the Chaos Game are morphed between key
+frames, and every frame is rendered into a numbered image.
+
+An animation spec is a JSON file with key frames; a key frame leaves out what has not changed since the previous one:
+
+    {"frames": 120, "size": 512, "count": 1000000, "seed": 1, "allowed": null, "rule": null,
+     "keys": [{"vertexes": "56,400 456,400 256,54", "ratio": "1:1"},
+              {"vertexes": "56,300 456,400 256,154", "ratio": "1:2"},
+              {"ratio": "1:1"}]}
+
+Key frames are spread evenly over the frames and the parameters are eased between them. Every frame is counted with
+the same seed, so every frame chooses the same sequence of vertexes: a point moves a little when the parameters move
+a little, and the picture morphs instead of flickering. Frames are rendered on a process pool and written by the
+workers, so no frame is kept in memory after it is done. A video can be made of them with e.g.
+
+    python animate.py spec.json frames && ffmpeg -i frames/frame_%05d.png morph.mp4
+
+Frames which are in the directory already are kept, unless the spec has changed since they were rendered.
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import render
+from cli import parse_pairs, parse_ratio
+
+# Values of a spec besides the key frames
+DEFAULTS = {'frames': 60, 'size': 512, 'count': 1000000, 'seed': 0, 'allowed': None, 'rule': None, 'tone': 'log',
+            'gamma': 1.0, 'colors': None, 'ease': 'smooth'}
+# Curves of the way between two key frames
+EASE = {'linear': lambda t: t, 'smooth': lambda t: t * t * (3 - 2 * t)}
+# Name of the frame files and of the copy of the spec next to them
+PATTERN = 'frame_{:05d}.png'
+SPEC = 'animation.json'
+# Frames handed to the pool ahead of the one being waited for, per process
+AHEAD = 2
+
+
+def key_frames(spec):
+    """Key frames of an animation with every parameter filled in
+
+    :param spec: dict, see the description of the file
+    :return: list of (vertexes, relation) pairs, vertexes is an array of shape (n, 2)
+    """
+    keys = spec.get('keys') or []
+    if not keys or 'vertexes' not in keys[0]:
+        raise ValueError('the first key frame must have the vertexes')
+    out = []
+    vertexes, relation = None, 1.0
+    for key in keys:
+        unknown = set(key) - {'vertexes', 'ratio'}
+        if unknown:
+            raise ValueError('unknown key frame keys: {}'.format(', '.join(sorted(unknown))))
+        if 'vertexes' in key:
+            points = key['vertexes']
+            points = np.array(parse_pairs(points) if isinstance(points, str) else points, dtype=np.float64)
+            if vertexes is not None and points.shape != vertexes.shape:
+                raise ValueError('all key frames must have the same number of vertexes')
+            vertexes = points
+        if 'ratio' in key:
+            relation = parse_ratio(key['ratio'])
+        out.append((vertexes, relation))
+    return out
+
+
+def frames(spec):
+    """Parameters of every frame
+
+    :param spec: dict, see the description of the file
+    :return: generator of dicts with the parameters of single renders
+    """
+    unknown = set(spec) - set(DEFAULTS) - {'keys'}
+    if unknown:
+        raise ValueError('unknown animation keys: {}'.format(', '.join(sorted(unknown))))
+    fixed = {k: spec.get(k, v) for k, v in DEFAULTS.items()}
+    if fixed['ease'] not in EASE:
+        raise ValueError('ease must be one of: {}'.format(', '.join(EASE)))
+    if fixed['frames'] < 1:
+        raise ValueError('there must be at least one frame')
+    keys = key_frames(spec)
+    n = len(keys[0][0])
+    allowed = fixed['allowed']
+    gaps = list(range(n)) if allowed is None else [g for g in map(int, str(allowed).split(',')) if g < n]
+    size = fixed['size']
+    width, height = (size, size) if isinstance(size, int) else size
+    for i in range(fixed['frames']):
+        # position of the frame in key frames, the last frame is on the last key frame
+        at = i * (len(keys) - 1) / max(1, fixed['frames'] - 1)
+        k = min(int(at), len(keys) - 2)
+        if k < 0:
+            vertexes, relation = keys[0]
+        else:
+            t = EASE[fixed['ease']](at - k)
+            (v0, r0), (v1, r1) = keys[k], keys[k + 1]
+            vertexes, relation = (1 - t) * v0 + t * v1, (1 - t) * r0 + t * r1
+        yield dict(fixed, index=i, width=width, height=height, vertexes=vertexes.tolist(), relation=relation,
+                   allowed=gaps)
+
+
+def render_frame(frame, path):
+    """Render one frame into its file
+
+    The image is written under a temporary name first, so an interrupted job never leaves a broken frame.
+
+    :param frame: dict made by frames
+    :param path: path of the PNG file
+    :return: path
+    """
+    colors = frame['colors']
+    density = render.render_chain(frame['vertexes'], frame['allowed'], frame['relation'], frame['count'],
+                                  frame['width'], frame['height'], len(frame['vertexes']) if colors else 1,
+                                  seed=frame['seed'], rule=frame['rule'])
+    try:
+        density.save(path + '.tmp.png', [tuple(c) for c in colors] if colors else None, frame['tone'],
+                     frame['gamma'])
+    finally:
+        density.close()
+    os.replace(path + '.tmp.png', path)
+    return path
+
+
+def run(spec, directory, workers=None):
+    """Render all frames of an animation which are not in the directory yet
+
+    When the spec differs from the one the frames in the directory were rendered with, those frames are removed
+    first. Frames are handed to the pool a few at a time and waited for in order, so a long animation never has all
+    its frames queued at once.
+
+    :param spec: dict, see the description of the file
+    :param directory: directory of the frames
+    :param workers: number of processes, one per CPU by default
+    :return: number of frames rendered
+    """
+    jobs = list(frames(spec))
+    os.makedirs(directory, exist_ok=True)
+    saved = os.path.join(directory, SPEC)
+    if os.path.exists(saved):
+        with open(saved) as f:
+            if json.load(f) != spec:
+                for old in glob.glob(os.path.join(directory, PATTERN.replace('{:05d}', '[0-9]' * 5))):
+                    os.remove(old)
+    with open(saved + '.tmp', 'w') as f:
+        json.dump(spec, f, indent=1)
+    os.replace(saved + '.tmp', saved)
+    jobs = [(frame, os.path.join(directory, PATTERN.format(frame['index']))) for frame in jobs]
+    jobs = [(frame, path) for frame, path in jobs if not os.path.exists(path)]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for i, (frame, path) in enumerate(jobs + [(None, None)] * (AHEAD * workers)):
+            if frame is not None:
+                pending.append(pool.submit(render_frame, frame, path))
+            if i >= AHEAD * workers:
+                pending.popleft().result()
+                print('{}/{} frames rendered'.format(i - AHEAD * workers + 1, len(jobs)), file=sys.stderr)
+    return len(jobs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render a morph of Chaos Game parameters into numbered frames.')
+    parser.add_argument('spec', help='JSON file with the animation')
+    parser.add_argument('output', help='directory for the frames')
+    parser.add_argument('--workers', default=None, type=int, help='number of processes, one per CPU by default')
+    args = parser.parse_args(argv)
+    try:
+        with open(args.spec) as f:
+            run(json.load(f), args.output, args.workers)
+    except ValueError as e:
+        parser.error(str(e))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
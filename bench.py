@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains a benchmark of the Chaos Game hot path.
+
+Every engine is run over a sweep of vertex counts, rule sets, ratios and output resolutions. Throughput in points per
+second and peak memory are saved as JSON, so results of two versions can be compared:
+
+    python bench.py -o new.json --compare old.json
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import itertools
+import random
+import numpy as np
+import model as m
+import render
+
+VERTEXES = (3, 4, 5, 6, 8, 10, 12)
+RULES = ('permissive', 'restrictive', 'no-return', 'repeat-not-neighbour')
+RATIOS = (1.0, 0.5, 2.0)
+RESOLUTIONS = (256, 1024, 4096)
+# Games of the exact render check as (vertexes, allowed gaps, ratio, rule), and the share of the lit pixels which may
+# be lit by only one of the exact and the random render
+EXACT_CASES = ((3, None, 1.0, None), (4, None, 1.0, 'repeat-not-neighbour'), (5, None, 1.0, None),
+               (3, None, 0.5, None))
+EXACT_MISMATCH = 0.02
+
+
+class Dot:
+    """Dot class
+
+    This class stands for a GUI dot: Fractal reads vertex positions through pos().x() and pos().y().
+
+    :param x and y: coordinates of the dot
+    """
+    def __init__(self, x, y):
+        self.__x = x
+        self.__y = y
+
+    def pos(self):
+        return self
+
+    def x(self):
+        return self.__x
+
+    def y(self):
+        return self.__y
+
+
+def allowed_gaps(rule, n):
+    """Allowed gaps of a rule set
+
+    :param rule: 'restrictive' for neighbours only, every gap for 'permissive' and the rules of model.RULES
+    :param n: number of vertexes
+    :return: list of gaps
+    """
+    return [1] if rule == 'restrictive' else list(range(n))
+
+
+def run_fractal(vertexes, allowed, relation, count, resolution, rule=None):
+    """The original path: one Fractal object per point, it knows the allowed gaps only"""
+    dots = {i: Dot(int(round(x)), int(round(y))) for i, (x, y) in enumerate(vertexes)}
+    rng = random.Random(0)
+    x, y, prev = resolution // 2, resolution // 2, 0
+    for _ in range(count):
+        f = m.Fractal(x, y, dots, allowed, relation, rng, prev)
+        x, y, prev = f.x - 4, f.y - 4, f.prev
+
+
+def run_batch(vertexes, allowed, relation, count, resolution, rule=None):
+    """The batch engine without rasterization"""
+    game = m.ChaosGame(vertexes, allowed, relation, seed=0, rule=rule)
+    for done in range(0, count, render.CHUNK):
+        game.next_batch(min(render.CHUNK, count - done))
+
+
+def run_render(vertexes, allowed, relation, count, resolution, rule=None):
+    """The batch engine counted into a density buffer and turned into an image"""
+    game = m.ChaosGame(vertexes, allowed, relation, seed=0, rule=rule)
+    density = render.Density(resolution, resolution, len(vertexes))
+    render.accumulate(game, density, count)
+    density.image([(255, 255, 255)] * len(vertexes))
+
+
+# name: (function, points per run, whether the resolution matters)
+ENGINES = {
+    'fractal': (run_fractal, 20000, False),
+    'batch': (run_batch, 2000000, False),
+    'render': (run_render, 2000000, True),
+}
+
+
+def measure(function, args, repeat):
+    """Measure one case
+
+    :param function: engine function
+    :param args: its arguments
+    :param repeat: number of timed runs, the best one counts
+    :return: best time in seconds and peak traced memory in bytes
+    """
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - begin)
+    return best, peak
+
+
+def cases(engines, vertexes=VERTEXES, rules=RULES, ratios=RATIOS, resolutions=RESOLUTIONS):
+    """All combinations of the sweep
+
+    :return: generator of (engine, vertexes, rule, ratio, resolution) tuples
+    """
+    for engine in engines:
+        sizes = resolutions if ENGINES[engine][2] else resolutions[:1]
+        known = [r for r in rules if r not in m.RULES or engine != 'fractal']
+        yield from ((engine,) + case for case in itertools.product(vertexes, known, ratios, sizes))
+
+
+def run(engines, scale=1.0, repeat=3, **sweep):
+    """Run the benchmark
+
+    :param engines: names of the engines, see ENGINES
+    :param scale: factor for the number of points of every engine
+    :param repeat: number of timed runs of every case
+    :param sweep: lists of vertexes, rules, ratios and resolutions to override the default sweep
+    :return: dict with the environment and a list of results
+    """
+    results = []
+    for engine, n, rule, ratio, resolution in cases(engines, **sweep):
+        function, count, _ = ENGINES[engine]
+        count = max(1, int(count * scale))
+        vertexes = m.polygon(n, resolution * 0.45, (resolution / 2, resolution / 2))
+        seconds, peak = measure(function, (vertexes, allowed_gaps(rule, n), ratio, count, resolution,
+                                           rule if rule in m.RULES else None), repeat)
+        results.append({'engine': engine, 'vertexes': n, 'rule': rule, 'ratio': ratio, 'resolution': resolution,
+                        'points': count, 'seconds': seconds, 'points_per_second': count / seconds,
+                        'peak_memory': peak})
+        print('{engine:8} n={vertexes:<3} {rule:20} r={ratio:<4} {resolution:>5}px '
+              '{points_per_second:>14,.0f} pts/s {peak_memory:>14,} B'.format(**results[-1]))
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'system': platform.system(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+
+def check_exact(count=50000000, resolution=512):
+    """Compare exact renders with long random ones
+
+    Both renders of a game are made with the same number of points, so a pixel should be lit in both or in neither,
+    apart from the pixels so faint that the random walk hits them by chance.
+
+    :param count: number of points of both renders
+    :param resolution: size of the images
+    :return: True if every game lit the same pixels within EXACT_MISMATCH
+    """
+    passed = True
+    for n, allowed, ratio, rule in EXACT_CASES:
+        vertexes = m.polygon(n, resolution * 0.45, (resolution / 2, resolution / 2))
+        allowed = list(range(n)) if allowed is None else allowed
+        exact = render.Density(resolution, resolution)
+        render.subdivide(m.ChaosGame(vertexes, allowed, ratio, rule=rule), exact, count)
+        walk = render.Density(resolution, resolution)
+        render.accumulate(render.make_game(vertexes, allowed, ratio, seed=0, rule=rule), walk, count)
+        exact, walk = exact.total() > 0, walk.total() > 0
+        mismatch = np.count_nonzero(exact != walk) / max(1, np.count_nonzero(walk))
+        passed &= mismatch <= EXACT_MISMATCH
+        print('n={:<3} {:20} r={:<4} lit exact {:>9,} random {:>9,} differ {:6.2%} {}'.format(
+            n, rule or 'no rule', ratio, np.count_nonzero(exact), np.count_nonzero(walk), mismatch,
+            'ok' if mismatch <= EXACT_MISMATCH else 'FAILED'))
+    return passed
+
+
+def compare(new, old):
+    """Print the change of throughput against older results
+
+    :param new and old: dicts made by run
+    """
+    key = lambda r: (r['engine'], r['vertexes'], r['rule'], r['ratio'], r['resolution'])
+    before = {key(r): r for r in old['results']}
+    for r in new['results']:
+        if key(r) in before:
+            change = r['points_per_second'] / before[key(r)]['points_per_second'] - 1
+            print('{:8} n={:<3} {:20} r={:<4} {:>5}px {:+8.1%}'.format(*key(r), change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Chaos Game engines.')
+    parser.add_argument('-o', '--output', default='bench.json', help='JSON file for the results')
+    parser.add_argument('--engines', default=','.join(ENGINES), help='comma separated engines to run')
+    parser.add_argument('--scale', default=1.0, type=float, help='factor for the number of points')
+    parser.add_argument('--repeat', default=3, type=int, help='timed runs of every case')
+    parser.add_argument('--quick', action='store_true', help='a small sweep for a quick check')
+    parser.add_argument('--compare', default=None, help='JSON file with older results to compare with')
+    parser.add_argument('--check-exact', action='store_true',
+                        help='check that exact renders light the same pixels as long random ones instead')
+    args = parser.parse_args(argv)
+    if args.check_exact:
+        return 0 if check_exact(max(1, int(50000000 * args.scale))) else 1
+    engines = args.engines.split(',')
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error('unknown engine {}'.format(engine))
+    sweep = {}
+    if args.quick:
+        sweep = {'vertexes': (3, 6, 12), 'ratios': (1.0,), 'resolutions': (256, 1024)}
+    result = run(engines, args.scale, args.repeat, **sweep)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the entry point of the application. Without a command it opens the window; the commands run the
+tools which work without a display and never import Qt, so batch workers start fast:
+
+    python chaos.py                                  the window, see view.pyw
+    python chaos.py render [options] output.png      see cli.py
+    python chaos.py sweep spec.json sheet.png        see sweep.py
+    python chaos.py animate spec.json frames         see animate.py
+    python chaos.py bench --quick                    see bench.py
+    python chaos.py compile-ui                       precompile gui.ui for a faster start of the window
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import os
+import sys
+import runpy
+import importlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# command: module with a main(argv) function
+COMMANDS = {'render': 'cli', 'sweep': 'sweep', 'animate': 'animate', 'bench': 'bench'}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return importlib.import_module(COMMANDS[argv[0]]).main(argv[1:])
+    if argv and argv[0] != 'compile-ui':
+        print('unknown command {}, expected one of: {}, compile-ui'.format(argv[0], ', '.join(COMMANDS)),
+              file=sys.stderr)
+        return 2
+    # Qt is loaded only here; view.pyw is run as a file since .pyw files can not be imported everywhere
+    view = runpy.run_path(os.path.join(HERE, 'view.pyw'))
+    return view['main']([sys.argv[0]] + (['--compile-ui'] if argv else []))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
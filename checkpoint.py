@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains saving and restoring of a whole render: the game with its random source and the density buffer.
+
+A checkpoint is a zip archive with the state of the game in state.json and the hit counts in counts.npy, compressed.
+Both are written and read in pieces, so tiled buffers larger than memory can be saved too.
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import os
+import json
+import zipfile
+import numpy as np
+import model as m
+import render
+
+
+def save(path, game, density, done=0):
+    """Save a render
+
+    The file is replaced only when it has been written completely.
+
+    :param path: path of the checkpoint file
+    :param game: model.ChaosGame object
+    :param density: render.Density or render.TiledDensity object
+    :param done: number of points counted so far
+    """
+    state = {'game': game.get_state(), 'done': int(done), 'width': int(density.width),
+             'height': int(density.height), 'channels': int(density.channels),
+             'origin': [float(x) for x in density.origin], 'scale': float(density.scale),
+             'band': getattr(density, 'band', None)}
+    temp = path + '.tmp'
+    with zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('state.json', json.dumps(state))
+        with archive.open('counts.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, density.counts)
+    os.replace(temp, path)
+
+
+def load(path):
+    """Restore a render
+
+    :param path: path of the checkpoint file
+    :return: model.ChaosGame object, density buffer and number of points counted so far
+    """
+    with zipfile.ZipFile(path) as archive:
+        state = json.loads(archive.read('state.json'))
+        game = m.game_from_state(state['game'])
+        with archive.open('counts.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            density = render.make_density(state['width'], state['height'], state['channels'], state['origin'],
+                                          state['scale'], state['band'], dtype)
+            assert shape == density.counts.shape and not fortran, 'counts do not match the buffer'
+            band = getattr(density, 'band', density.height)
+            for channel in range(density.channels):
+                for top in range(0, density.height, band):
+                    rows = min(band, density.height - top)
+                    data = f.read(rows * density.width * dtype.itemsize)
+                    density.counts[channel, top:top + rows] = np.frombuffer(data, dtype).reshape(rows, -1)
+    return game, density, state['done']
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains a command-line runner of the Chaos Game method. It works without Qt and without a display.
+
+Example:
+    python cli.py -v "0,0 400,0 200,346" -a 0,1,2 -r 1:1 -n 1000000 --seed 1 sierpinski.png
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import model as m
+import render
+import checkpoint
+
+# Buffers with more hit counters than this are kept on disk in bands, see render.TiledDensity
+TILED = 1 << 26
+
+
+def parse_pairs(text):
+    """Parse a list of points
+
+    :param text: string like "0,0 400,0 200,346"
+    :return: list of (x, y) tuples
+    """
+    return [tuple(map(float, p.split(','))) for p in text.split()]
+
+
+def parse_maps(text):
+    """Parse IFS maps
+
+    :param text: "fern", or groups of 6 or 7 numbers (a,b,c,d,e,f[,p]) separated by spaces
+    :return: list of tuples, see model.IFS
+    """
+    if text == 'fern':
+        return m.FERN
+    return [tuple(map(float, f.split(','))) for f in text.split()]
+
+
+def parse_ratio(text):
+    """Parse a ratio in the same "r1:r2" form as in the GUI
+
+    :param text: string like "1:1"
+    :return: relation as float
+    """
+    r1, r2 = tuple(map(int, text.split(':')))
+    if not (r1 > 0 and r2 > 0):
+        raise ValueError('ratio parts must be positive')
+    return r1 / r2
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Render a fractal with the Chaos Game method.')
+    parser.add_argument('output', help='output file: .png, .tif or .tiff for an image, .npy for an array of points')
+    parser.add_argument('-v', '--vertexes', default=None, type=parse_pairs,
+                        help='vertex coordinates, e.g. "0,0 400,0 200,346"')
+    parser.add_argument('--maps', default=None, type=parse_maps,
+                        help='run an IFS instead: "fern" or affine maps "a,b,c,d,e,f,p ..." for '
+                             "x' = a*x + b*y + e, y' = c*x + d*y + f chosen with probability p")
+    parser.add_argument('-a', '--allowed', default=None, type=lambda t: list(map(int, t.split(','))),
+                        help='allowed gaps between consecutive vertexes, e.g. "0,1,2"; all gaps by default')
+    parser.add_argument('--rule', default=None, choices=sorted(m.RULES),
+                        help='rule on the last chosen vertexes applied on top of the allowed gaps')
+    parser.add_argument('-r', '--ratio', default='1:1', type=parse_ratio, help='relation ratio, e.g. "1:1"')
+    parser.add_argument('-n', '--count', default=100000, type=int, help='number of points')
+    parser.add_argument('--seed', default=None, type=int, help='seed of the random generator')
+    parser.add_argument('--rng', default='numpy', choices=sorted(m.RNGS), help='random source')
+    parser.add_argument('--start', default=None, type=lambda t: parse_pairs(t)[0],
+                        help='initial point, e.g. "10,10"; the render starts on the attractor by default')
+    parser.add_argument('--burn', default=render.BURN, type=int,
+                        help='points thrown away after --start while the orbit comes to the attractor')
+    parser.add_argument('--colors', default=None, type=lambda t: [tuple(map(int, p.split(','))) for p in t.split()],
+                        help='colour of every vertex, e.g. "255,0,0 0,255,0 0,0,255"; white by default')
+    parser.add_argument('--tone', default='log', choices=render.TONES, help='density tone curve')
+    parser.add_argument('--gamma', default=1.0, type=float, help='gamma applied after the tone curve')
+    parser.add_argument('--size', default=None, type=lambda t: tuple(map(int, t.lower().split('x'))),
+                        help='image size, e.g. 800x600; fits the vertexes by default, 800x800 for an IFS')
+    parser.add_argument('--scale', default=1.0, type=float, help='pixels per coordinate unit')
+    parser.add_argument('--band', default=None, type=int,
+                        help='keep the buffer on disk and process it in bands of this many rows; '
+                             'used automatically for large images')
+    parser.add_argument('--checkpoint', default=None,
+                        help='file to save the render to while it runs; if it exists the render goes on from it')
+    parser.add_argument('--every', default=60.0, type=float, help='seconds between checkpoints')
+    parser.add_argument('--stats', action='store_true', help='print throughput counters to stderr at the end')
+    parser.add_argument('--converge', action='store_true',
+                        help='stop before --count points once the image changes by less than --tol between checks')
+    parser.add_argument('--tol', default=render.CONVERGED, type=float,
+                        help='largest change between checks of a converged image, see --converge')
+    parser.add_argument('--exact', action='store_true',
+                        help='render the attractor without randomness by subdividing it; --count, --seed and --chains '
+                             'are not used')
+    parser.add_argument('--chains', default=1, type=int, help='number of independent chains for an image')
+    parser.add_argument('--workers', default=None, type=int, help='number of processes, one per CPU by default')
+    return parser
+
+
+def resume(args, width, height, channels):
+    """Render with checkpoints
+
+    Goes on from the checkpoint file if it exists, until args.count points are counted in total or the image
+    converges.
+
+    :param args: parsed arguments
+    :param width and height: size of the image
+    :param channels: number of channels of the buffer
+    :return: density buffer
+    """
+    if os.path.exists(args.checkpoint):
+        game, density, done = checkpoint.load(args.checkpoint)
+    else:
+        game = render.make_game(args.vertexes, args.allowed, args.ratio, args.seed, args.start, args.burn, args.rng,
+                                args.maps, args.rule)
+        density = render.make_density(width, height, channels, args.origin, args.scale, args.band)
+        done = 0
+    game.stats = density.stats
+    convergence = render.Convergence(density, args.tol, done) if args.converge else None
+    saved = time.monotonic()
+
+    def progress(n):
+        nonlocal saved
+        if time.monotonic() - saved >= args.every:
+            checkpoint.save(args.checkpoint, game, density, done + n)
+            saved = time.monotonic()
+
+    try:
+        done += render.accumulate(game, density, max(0, args.count - done), progress, convergence)
+        checkpoint.save(args.checkpoint, game, density, done)
+    except BaseException:
+        density.close()
+        raise
+    report(convergence)
+    return density
+
+
+def report(convergence):
+    """Print the points to convergence to stderr
+
+    :param convergence: render.Convergence object or None
+    """
+    if convergence is None:
+        return
+    if convergence.converged:
+        print('converged after {:,} points'.format(convergence.points), file=sys.stderr)
+    else:
+        print('not converged after {:,} points: {}'.format(convergence.done, convergence), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if (args.vertexes is None) == (args.maps is None):
+        parser.error('either --vertexes or --maps is required')
+    if args.allowed is None and args.vertexes is not None:
+        args.allowed = list(range(len(args.vertexes)))
+    if args.colors is not None:
+        if len(args.colors) != len(args.maps or args.vertexes):
+            parser.error('--colors needs one colour for every {}'.format('map' if args.maps else 'vertex'))
+        if any(len(c) != 3 or not all(0 <= v <= 255 for v in c) for c in args.colors):
+            parser.error('--colors must be r,g,b triples from 0 to 255')
+    density = None
+    try:
+        if args.output.endswith('.npy'):
+            game = render.make_game(args.vertexes, args.allowed, args.ratio, args.seed, args.start, args.burn,
+                                    args.rng, args.maps, args.rule)
+            xs, ys, vers = game.next_batch(args.count)
+            np.save(args.output, np.stack((xs, ys, vers), axis=1))
+            return 0
+        args.origin = (0, 0)
+        if args.maps is not None:
+            width, height = args.size or (800, 800)
+            args.origin, args.scale = render.fit(render.make_game(None, None, None, 0, maps=args.maps), width,
+                                                 height)
+        elif args.size:
+            width, height = args.size
+        else:
+            width, height = map(int, np.max(args.vertexes, axis=0) * args.scale + 1)
+        channels = len(args.maps or args.vertexes) if args.colors else 1
+        if args.band is None and width * height * channels > TILED:
+            args.band = 256
+        if args.exact:
+            if args.maps is not None or args.checkpoint:
+                parser.error('--exact works with --vertexes and without --checkpoint')
+            density = render.make_density(width, height, channels, args.origin, args.scale, args.band)
+            render.subdivide(render.make_game(args.vertexes, args.allowed, args.ratio, rule=args.rule), density)
+        elif args.checkpoint:
+            if args.chains != 1:
+                parser.error('--checkpoint works with one chain only')
+            density = resume(args, width, height, channels)
+        elif args.converge:
+            if args.chains != 1:
+                parser.error('--converge works with one chain only')
+            game = render.make_game(args.vertexes, args.allowed, args.ratio, args.seed, args.start, args.burn,
+                                    args.rng, args.maps, args.rule)
+            density = render.make_density(width, height, channels, args.origin, args.scale, args.band)
+            game.stats = density.stats
+            convergence = render.Convergence(density, args.tol)
+            render.accumulate(game, density, args.count, convergence=convergence)
+            report(convergence)
+        else:
+            density = render.render_chains(args.vertexes, args.allowed, args.ratio, args.count, width, height, channels,
+                                           args.seed, args.start, args.burn, args.rng, origin=args.origin,
+                                           scale=args.scale, band=args.band, maps=args.maps, rule=args.rule,
+                                           chains=args.chains, workers=args.workers)
+        with density.stats.timer('save'):
+            density.save(args.output, args.colors, args.tone, args.gamma)
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        # the buffer file of a large image is removed also when the render fails or is interrupted
+        if density is not None:
+            density.close()
+    if args.stats:
+        print(density.stats, file=sys.stderr)
+        print(json.dumps(density.stats.snapshot()), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains writers of the rendered images. They need neither Qt nor any imaging library.
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import os
+import struct
+import zlib
+import numpy as np
+
+
+class PngWriter:
+    """PngWriter class
+
+    This class writes an 8-bit PNG image row by row, so the whole image never has to be kept in memory.
+
+    :param path: path of the file to write
+    :param width and height: size of the image in pixels
+    :param channels: 1 for grayscale, 3 for RGB
+    """
+    def __init__(self, path, width, height, channels=3):
+        assert channels in (1, 3), 'channels must be 1 or 3'
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows = 0
+        self.path = path
+        self.__file = open(path, 'wb')
+        self.__zip = zlib.compressobj(6)
+        self.__file.write(b'\x89PNG\r\n\x1a\n')
+        self.__chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2 if channels == 3 else 0, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, *args):
+        if kind is None:
+            self.close()
+        else:
+            self.discard()
+
+    def __chunk(self, kind, data):
+        self.__file.write(struct.pack('>I', len(data)) + kind + data)
+        self.__file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, rows):
+        """Write next rows
+
+        :param rows: uint8 array of shape (n, width) or (n, width, channels)
+        """
+        rows = np.asarray(rows, dtype=np.uint8).reshape(-1, self.width * self.channels)
+        assert self.rows + len(rows) <= self.height, 'too many rows'
+        data = np.zeros((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        data[:, 1:] = rows
+        self.rows += len(rows)
+        data = self.__zip.compress(data.tobytes())
+        if data:
+            self.__chunk(b'IDAT', data)
+
+    def close(self):
+        """Finish the file"""
+        if self.__file.closed:
+            return
+        assert self.rows == self.height, 'image is not complete'
+        self.__chunk(b'IDAT', self.__zip.flush())
+        self.__chunk(b'IEND', b'')
+        self.__file.close()
+
+    def discard(self):
+        """Close and remove an unfinished file"""
+        if not self.__file.closed:
+            self.__file.close()
+            os.remove(self.path)
+
+
+class TiffWriter:
+    """TiffWriter class
+
+    This class writes an uncompressed 8-bit TIFF image row by row. Rows are stored in strips as they come, the
+    directory of the strips is written at the end.
+
+    :param path: path of the file to write
+    :param width and height: size of the image in pixels
+    :param channels: 1 for grayscale, 3 for RGB
+    :param strip: number of rows in a strip
+    """
+    def __init__(self, path, width, height, channels=3, strip=64):
+        assert channels in (1, 3), 'channels must be 1 or 3'
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.strip = strip
+        self.rows = 0
+        self.__pending = bytearray()
+        self.__offsets = []
+        self.__counts = []
+        self.path = path
+        self.__file = open(path, 'wb')
+        self.__file.write(b'II*\x00\x00\x00\x00\x00')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, *args):
+        if kind is None:
+            self.close()
+        else:
+            self.discard()
+
+    def __flush(self, size):
+        self.__offsets.append(self.__file.tell())
+        self.__counts.append(size)
+        self.__file.write(self.__pending[:size])
+        del self.__pending[:size]
+
+    def write(self, rows):
+        """Write next rows
+
+        :param rows: uint8 array of shape (n, width) or (n, width, channels)
+        """
+        rows = np.asarray(rows, dtype=np.uint8).reshape(-1, self.width * self.channels)
+        assert self.rows + len(rows) <= self.height, 'too many rows'
+        self.rows += len(rows)
+        self.__pending += rows.tobytes()
+        size = self.strip * self.width * self.channels
+        while len(self.__pending) >= size:
+            self.__flush(size)
+
+    def close(self):
+        """Finish the file"""
+        if self.__file.closed:
+            return
+        assert self.rows == self.height, 'image is not complete'
+        if self.__pending:
+            self.__flush(len(self.__pending))
+        if self.__file.tell() % 2:
+            self.__file.write(b'\x00')
+        start = self.__file.tell()
+        entries = [(256, 4, [self.width]), (257, 4, [self.height]), (258, 3, [8] * self.channels), (259, 3, [1]),
+                   (262, 3, [2 if self.channels == 3 else 1]), (273, 4, self.__offsets),
+                   (277, 3, [self.channels]), (278, 4, [self.strip]), (279, 4, self.__counts), (284, 3, [1])]
+        extra = start + 2 + 12 * len(entries) + 4
+        directory, data = [struct.pack('<H', len(entries))], []
+        for tag, kind, values in entries:
+            packed = struct.pack('<{}{}'.format(len(values), 'H' if kind == 3 else 'I'), *values)
+            if len(packed) <= 4:
+                directory.append(struct.pack('<HHI', tag, kind, len(values)) + packed.ljust(4, b'\x00'))
+            else:
+                directory.append(struct.pack('<HHII', tag, kind, len(values), extra))
+                data.append(packed)
+                extra += len(packed)
+        directory.append(struct.pack('<I', 0))
+        self.__file.write(b''.join(directory + data))
+        self.__file.seek(4)
+        self.__file.write(struct.pack('<I', start))
+        self.__file.close()
+
+    def discard(self):
+        """Close and remove an unfinished file"""
+        if not self.__file.closed:
+            self.__file.close()
+            os.remove(self.path)
+
+
+WRITERS = {'.png': PngWriter, '.tif': TiffWriter, '.tiff': TiffWriter}
+
+
+def open_image(path, width, height, channels=3):
+    """Open an image file for writing row by row
+
+    :param path: path of the file, its extension chooses the format: .png, .tif or .tiff
+    :param width and height: size of the image in pixels
+    :param channels: 1 for grayscale, 3 for RGB
+    :return: PngWriter or TiffWriter object
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError('unknown image format {}'.format(extension))
+    return WRITERS[extension](path, width, height, channels)
+
+
+def write_png(path, pixels):
+    """Write an image to a PNG file
+
+    :param path: path of the file to write
+    :param pixels: uint8 array of shape (height, width) or (height, width, 3)
+    """
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    channels = 3 if pixels.ndim == 3 else 1
+    with PngWriter(path, pixels.shape[1], pixels.shape[0], channels) as png:
+        png.write(pixels)
@@ -6,9 +6,88 @@ This file contains main algorithm for calculating a point coordinates according
 
 @author: Dyma Volodymyr Sergiyovoich
 """
+import os
+import time
 import secrets as s
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
 
-prevVer1 = 0
+# Number of points computed by the batch engine in one pass. Bounds the size of the temporary arrays.
+BLOCK = 1 << 18
+# Largest number of states of the rules, a state is a sequence of the last order vertexes
+MAX_STATES = 1 << 14
+# Number of points computed at once while iterating over a game point by point
+ITER_BLOCK = 1 << 12
+# Seconds of history used for the current points per second
+RATE_WINDOW = 2.0
+
+
+class Stats:
+    """Stats class
+
+    This class collects throughput counters of a run: points generated, random values drawn, and seconds spent in
+    every stage (generate, rasterize, repaint). One object can be shared by a game, a density buffer and a window.
+    """
+    def __init__(self):
+        self.points = 0
+        self.draws = 0
+        self.seconds = {}
+        self.__history = deque([(time.perf_counter(), 0)])
+
+    @contextmanager
+    def timer(self, stage):
+        """Add the time spent in a with block to a stage
+
+        :param stage: name of the stage
+        """
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - begin
+
+    def add(self, points, draws=0):
+        """Count generated points
+
+        :param points: number of points
+        :param draws: number of random values drawn for them
+        """
+        self.points += points
+        self.draws += draws
+        now = time.perf_counter()
+        self.__history.append((now, self.points))
+        while len(self.__history) > 2 and now - self.__history[1][0] > RATE_WINDOW:
+            self.__history.popleft()
+
+    def rate(self):
+        """Current points per second
+
+        :return: points per second over the last RATE_WINDOW seconds
+        """
+        (first, before), (last, after) = self.__history[0], self.__history[-1]
+        return (after - before) / (last - first) if last > first else 0.0
+
+    def merge(self, other):
+        """Add counters of another run
+
+        :param other: Stats object
+        """
+        self.add(other.points, other.draws)
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def snapshot(self):
+        """Counters as plain data
+
+        :return: dict with points, draws, seconds per stage and points per second
+        """
+        return {'points': self.points, 'draws': self.draws, 'seconds': dict(self.seconds), 'rate': self.rate()}
+
+    def __str__(self):
+        total = sum(self.seconds.values()) or 1.0
+        stages = ' '.join('{} {:.0%}'.format(stage, seconds / total) for stage, seconds in sorted(self.seconds.items()))
+        return '{:,} pts | {:,.0f} pts/s | {}'.format(self.points, self.rate(), stages)
 
 
 class Fractal:
@@ -19,8 +98,11 @@ class Fractal:
     :param x and y: are coordinates of the last placed point.
     :param vertexes: is a dictionary of the vertexes available for moving to
     :param allowed: is a list of allowed gaps between the previously chosen vertex and currently chosen one
+    :param rng: random source with a choice method, secrets module by default. random.Random(seed) makes it
+        reproducible
+    :param prev: previously chosen vertex, pass prev of the previous Fractal to go on with the same game
     """
-    def __init__(self, x, y, vertexes, allowed, relation):
+    def __init__(self, x, y, vertexes, allowed, relation, rng=s, prev=0):
         assert isinstance(x, int) and isinstance(y, int), 'x and y type must be integer'
         assert isinstance(vertexes, dict), 'vertexes type must be dict'
         assert isinstance(allowed, list), 'allowed type must be list'
@@ -30,6 +112,8 @@ class Fractal:
         self.allowed = allowed
         self.vertexes = vertexes
         self.relation = relation
+        self.rng = rng
+        self.prev = prev
         self.draw()
 
     def coordinates(self):
@@ -37,18 +121,16 @@ class Fractal:
 
         :return: list of x coord, y coord and currently chosen vertex object
         """
-        return self.x, self.y, self.vertexes[prevVer1]
+        return self.x, self.y, self.vertexes[self.prev]
 
     def draw(self):
         """Calculates coordinates to move to
         """
-        global prevVer1
-        while True:
-            t = s.choice(list(self.vertexes.keys()))
-            if abs(t - prevVer1) in self.allowed:
-                prevVer1 = t
-                t = self.vertexes[t]
-                break
+        legal = [t for t in self.vertexes.keys() if abs(t - self.prev) in self.allowed]
+        if not legal:
+            raise ValueError('there is no allowed vertex after vertex {}'.format(self.prev))
+        self.prev = self.rng.choice(legal)
+        t = self.vertexes[self.prev]
         x, y = t.pos().x(), t.pos().y()
         self.x, self.y = self.mid_point(self.x, self.y, x, y, self.relation)
 
@@ -71,3 +153,637 @@ class Fractal:
         x = (x1 + x2*k) / (1 + k)
         y = (y1 + y2*k) / (1 + k)
         return int(round(x)), int(round(y))
+
+
+class ChaosGame:
+    """ChaosGame class
+
+    This class is a batch engine for the Chaos Game method. It follows the same rules as Fractal but produces a whole
+    array of points in one call. Every object keeps its own state: the current point and the last chosen vertexes, so
+    the game can be continued by the next call and several games can run at once. It starts at the centre of the
+    vertexes.
+
+    Besides the allowed gaps a rule may look at several last chosen vertexes. The rules are compiled into a finite
+    state machine whose states are the last order vertexes, and the machine is walked with the same transition table
+    as the simple rules, see compile_rules.
+
+    :param vertexes: sequence of (x, y) pairs with coordinates of the vertexes
+    :param allowed: is a list of allowed gaps between the previously chosen vertex and currently chosen one
+    :param relation: relation ratio
+    :param seed: seed for the random generator, None for a fresh one
+    :param rng: random source, see make_rng. Overrides seed
+    :param dtype: float type of the returned coordinates, np.float32 halves the memory
+    :param rule: name of a rule from RULES, or function rule(history, vertex, n) telling if vertex may follow the
+        history, a tuple of the last order vertexes with the latest one at the end
+    :param order: number of last vertexes a rule function looks at, named rules know their own
+    """
+    def __init__(self, vertexes, allowed, relation, seed=None, rng=None, dtype=np.float64, rule=None, order=1):
+        assert isinstance(allowed, list), 'allowed type must be list'
+        assert isinstance(relation, float), 'relation type must be float'
+        if not relation > 0:
+            raise ValueError('relation must be positive')
+        self.vertexes = np.asarray(vertexes, dtype=np.float64).reshape(-1, 2)
+        if not len(self.vertexes):
+            raise ValueError('at least one vertex is required')
+        self.allowed = allowed
+        self.relation = relation
+        self.rng = rng if rng is not None else make_rng('numpy', seed)
+        self.dtype = dtype
+        if isinstance(rule, str):
+            if rule not in RULES:
+                raise ValueError('unknown rule {}'.format(rule))
+            function, order = RULES[rule]
+        else:
+            function = rule
+        assert isinstance(order, int) and order > 0, 'order must be positive int'
+        if len(self.vertexes) ** order > MAX_STATES:
+            raise ValueError('rules on the last {} of {} vertexes have too many states, at most {} are allowed'.format(
+                order, len(self.vertexes), MAX_STATES))
+        self.rule = rule
+        self.order = order
+        self.legal = compile_rules(len(self.vertexes), allowed, function, order)
+        self.moves = (np.arange(len(self.legal))[:, None] * len(self.vertexes) + np.arange(len(self.vertexes))) \
+            % len(self.legal)
+        self.table, self.degree = transitions(self.legal)
+        self.position = self.vertexes.mean(axis=0)
+        self.state = 0
+        self.stats = Stats()
+
+    @property
+    def prev(self):
+        """Last chosen vertex"""
+        return self.state % len(self.vertexes)
+
+    def history(self, *vertexes):
+        """State of the machine after the given vertexes
+
+        :param vertexes: last chosen vertexes, the latest one at the end. The first one fills the older history
+        :return: state number
+        """
+        vertexes = (vertexes[0],) * self.order + vertexes[1:]
+        state = 0
+        for v in vertexes[-self.order:]:
+            state = state * len(self.vertexes) + int(v)
+        return state
+
+    def reset(self, x, y, prev=0):
+        """Start the game over
+
+        :param x and y: are coordinates of the initial point
+        :param prev: previously chosen vertex, or a tuple of last chosen vertexes for rules of higher order
+        """
+        state = self.history(*np.atleast_1d(prev).tolist())
+        self.check(state)
+        self.position = np.array([x, y], dtype=np.float64)
+        self.state = state
+
+    def settle(self):
+        """Move to a point of the attractor
+
+        The rules are followed from the current state, always taking the first allowed vertex, until a state comes
+        again. The fixed point of that cycle of moves lies on the attractor, so are all points after it and there is
+        no transient to throw away. If a vertex may follow itself the point is that vertex.
+        """
+        self.check(self.state)
+        seen, path = {}, []
+        state = self.state
+        while state not in seen:
+            seen[state] = len(path)
+            state = int(self.table[state, 0])
+            path.append(state)
+        cycle = path[seen[state]:]
+        a = 1 / (1 + self.relation)
+        pos = np.zeros(2)
+        for step in cycle:
+            pos = a * pos + (1 - a) * self.vertexes[step % len(self.vertexes)]
+        self.position = pos / (1 - a ** len(cycle))
+        self.state = state
+
+    def transient(self, tolerance):
+        """Number of points off the attractor
+
+        :param tolerance: distance to the attractor which is small enough
+        :return: number of points after which the orbit is closer than tolerance to the attractor
+        """
+        a = 1 / (1 + self.relation)
+        error = np.abs(self.vertexes - self.position).sum(axis=1).max()
+        if error <= tolerance:
+            return 0
+        return int(np.ceil(np.log(tolerance / error) / np.log(a)))
+
+    def get_state(self):
+        """Full state of the game as plain data
+
+        :return: dict with the rules, the current point, the state of the rules and the state of the random source
+        """
+        if self.rule is not None and not isinstance(self.rule, str):
+            raise ValueError('only named rules can be saved')
+        return {'kind': 'chaos', 'vertexes': self.vertexes.tolist(), 'allowed': list(self.allowed),
+                'relation': self.relation, 'rule': self.rule, 'order': self.order,
+                'dtype': np.dtype(self.dtype).name, 'position': self.position.tolist(), 'state': int(self.state),
+                'rng': rng_state(self.rng)}
+
+    @classmethod
+    def from_state(cls, state):
+        """Restore a game
+
+        :param state: dict made by get_state
+        :return: ChaosGame object which goes on exactly where the saved one stopped
+        """
+        game = cls(state['vertexes'], state['allowed'], state['relation'], rng=rng_from_state(state['rng']),
+                   dtype=np.dtype(state['dtype']).type, rule=state.get('rule'), order=state.get('order', 1))
+        game.position = np.array(state['position'], dtype=np.float64)
+        game.state = state['state'] if 'state' in state else state['prev']
+        return game
+
+    def __iter__(self):
+        """Yields points one by one
+
+        Points are calculated ahead in batches, so the state of the game runs up to ITER_BLOCK points ahead of the
+        last yielded one.
+
+        :return: generator of (x, y, vertex) tuples
+        """
+        while True:
+            xs, ys, vers = self.next_batch(ITER_BLOCK)
+            yield from zip(xs.tolist(), ys.tolist(), vers.tolist())
+
+    def batches(self, size):
+        """Yields batches of points endlessly
+
+        :param size: number of points in a batch
+        :return: generator of batches, see next_batch
+        """
+        while True:
+            yield self.next_batch(size)
+
+    def check(self, state):
+        """Check that the game can go on forever
+
+        :param state: state of the rules, see history
+        :raise ValueError: if some state reachable from the given one has no allowed vertex after it
+        """
+        dead = np.flatnonzero(self.reachable(state) & (self.degree == 0))
+        if len(dead):
+            raise ValueError('there is no allowed vertex after vertexes {}'.format(self.vertexes_of(dead[0])))
+
+    def reachable(self, state):
+        """States the rules can reach
+
+        :param state: state of the rules, see history
+        :return: boolean array telling for every state if it can be reached from the given one, itself included
+        """
+        seen = np.zeros(len(self.legal), dtype=bool)
+        seen[state] = True
+        front = seen.copy()
+        while front.any():
+            reached = np.zeros_like(seen)
+            reached[self.moves[front][self.legal[front]]] = True
+            front = reached & ~seen
+            seen |= front
+        return seen
+
+    def vertexes_of(self, state):
+        """Last chosen vertexes in a state
+
+        :param state: state number
+        :return: tuple of vertexes, the latest one at the end
+        """
+        n = len(self.vertexes)
+        return tuple(int(state) // n ** k % n for k in reversed(range(self.order)))
+
+    def next_batch(self, count):
+        """Calculates next batch of points
+
+        The orbit is always followed in float64 without rounding, the returned coordinates are converted to dtype.
+        They are rounded only when counted into a raster, see render.Density.
+
+        :param count: number of points to calculate
+        :return: arrays of x coords, y coords and chosen vertexes
+        """
+        state = self.state
+        self.check(state)
+        a = 1 / (1 + self.relation)
+        b = self.relation * a
+        out = np.empty((count, 2), dtype=self.dtype)
+        vers = np.empty(count, dtype=np.intp)
+        pos = self.position
+        with self.stats.timer('generate'):
+            for start in range(0, count, BLOCK):
+                n = min(BLOCK, count - start)
+                chosen, state = self.choose(n, state)
+                c = self.vertexes[chosen] * b
+                c[0] += a * pos
+                contract(c, a)
+                out[start:start+n] = c
+                vers[start:start+n] = chosen
+                pos = c[-1].copy()
+        self.position, self.state = pos, state
+        self.stats.add(count, count)
+        return out[:, 0], out[:, 1], vers
+
+    def choose(self, count, state):
+        """Chooses vertexes to move to
+
+        Every vertex is drawn directly from the allowed ones in the current state, so each step takes the same time
+        however restrictive the rules are.
+
+        :param count: number of vertexes to choose
+        :param state: state of the rules, see history
+        :return: array of chosen vertexes and the state after them
+        """
+        n = len(self.vertexes)
+        if self.legal.all():
+            chosen = self.rng.integers(n, size=count)
+            for v in chosen[-self.order:].tolist():
+                state = int(self.moves[state, v])
+            return chosen, state
+        if not count:
+            return np.empty(0, dtype=np.intp), state
+        u = self.rng.random(count)
+        states = walk(self.table, self.degree, u, state, np.flatnonzero(self.reachable(state)))
+        return states % n, int(states[-1])
+
+
+class IFS(ChaosGame):
+    """IFS class
+
+    This class is a batch engine for iterated function systems: every step applies an affine map chosen at random
+    with its own probability. A map is (a, b, c, d, e, f) for x' = a*x + b*y + e, y' = c*x + d*y + f, optionally
+    followed by its probability. Maps without probabilities are chosen uniformly. Chosen maps are returned in place
+    of vertexes, so they can be coloured like vertexes.
+
+    :param maps: sequence of 6 or 7 numbers for every map
+    :param seed: seed for the random generator, None for a fresh one
+    :param rng: random source, see make_rng. Overrides seed
+    :param dtype: float type of the returned coordinates
+    """
+    def __init__(self, maps, seed=None, rng=None, dtype=np.float64):
+        maps = [tuple(map(float, f)) for f in maps]
+        assert maps and all(len(f) in (6, 7) for f in maps), 'every map must have 6 coefficients and a probability'
+        self.maps = maps
+        coefficients = np.array([f[:6] for f in maps])
+        self.matrices = coefficients[:, :4].reshape(-1, 2, 2)
+        self.translations = coefficients[:, 4:].copy()
+        weights = np.array([f[6] if len(f) == 7 else 1.0 for f in maps])
+        assert (weights >= 0).all() and weights.sum() > 0, 'probabilities must be non-negative'
+        self.cdf = np.cumsum(weights) / weights.sum()
+        self.rng = rng if rng is not None else make_rng('numpy', seed)
+        self.dtype = dtype
+        self.position = np.zeros(2)
+        self.state = 0
+        self.stats = Stats()
+
+    @property
+    def prev(self):
+        """Last chosen map"""
+        return self.state
+
+    def reset(self, x, y, prev=0):
+        self.position = np.array([x, y], dtype=np.float64)
+        self.state = int(prev)
+
+    def check(self, prev):
+        """Every map can follow every other one, so an IFS never gets stuck"""
+
+    def settle(self):
+        """Move to the fixed point of the most probable map, which lies on the attractor"""
+        weights = np.diff(self.cdf, prepend=0)
+        for k in np.argsort(-weights, kind='stable'):
+            fixed = np.eye(2) - self.matrices[k]
+            if abs(np.linalg.det(fixed)) > 1e-12:
+                self.position = np.linalg.solve(fixed, self.translations[k])
+                self.state = int(k)
+                return
+
+    def get_state(self):
+        return {'kind': 'ifs', 'maps': [list(f) for f in self.maps], 'dtype': np.dtype(self.dtype).name,
+                'position': self.position.tolist(), 'state': int(self.state), 'rng': rng_state(self.rng)}
+
+    @classmethod
+    def from_state(cls, state):
+        game = cls(state['maps'], rng=rng_from_state(state['rng']), dtype=np.dtype(state['dtype']).type)
+        game.position = np.array(state['position'], dtype=np.float64)
+        game.state = state['state'] if 'state' in state else state['prev']
+        return game
+
+    def next_batch(self, count):
+        out = np.empty((count, 2), dtype=self.dtype)
+        chosen = np.empty(count, dtype=np.intp)
+        pos = self.position
+        with self.stats.timer('generate'):
+            for start in range(0, count, BLOCK):
+                n = min(BLOCK, count - start)
+                k = np.searchsorted(self.cdf, self.rng.random(n), side='right').clip(max=len(self.cdf) - 1)
+                matrices = self.matrices[k]
+                c = self.translations[k]
+                c[0] += matrices[0] @ pos
+                matrices[0] = 0
+                contract_affine(matrices, c)
+                out[start:start+n] = c
+                chosen[start:start+n] = k
+                pos = c[-1].copy()
+        self.position = pos
+        if count:
+            self.state = int(chosen[-1])
+        self.stats.add(count, count)
+        return out[:, 0], out[:, 1], chosen
+
+
+def affine(scale=1.0, rotation=0.0, shear=0.0, translation=(0.0, 0.0), probability=None):
+    """Build an IFS map
+
+    The point is scaled first, then sheared along x, rotated and moved.
+
+    :param scale: scale factor, or a (sx, sy) pair
+    :param rotation: rotation angle in radians
+    :param shear: shear factor along x
+    :param translation: (x, y) pair
+    :param probability: probability of the map, None to leave it out
+    :return: tuple of coefficients for IFS
+    """
+    sx, sy = (scale, scale) if np.isscalar(scale) else scale
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    matrix = np.array([[cos, -sin], [sin, cos]]) @ np.array([[1.0, shear], [0.0, 1.0]]) @ np.diag([sx, sy])
+    f = tuple(matrix.ravel().tolist()) + (float(translation[0]), float(translation[1]))
+    return f if probability is None else f + (float(probability),)
+
+
+# Barnsley fern, with y growing downwards like on the screen
+FERN = [(0.0, 0.0, 0.0, 0.16, 0.0, 0.0, 0.01),
+        (0.85, -0.04, 0.04, 0.85, 0.0, -1.6, 0.85),
+        (0.2, 0.26, -0.23, 0.22, 0.0, -1.6, 0.07),
+        (-0.15, -0.28, -0.26, 0.24, 0.0, -0.44, 0.07)]
+GAMES = {'chaos': ChaosGame, 'ifs': IFS}
+
+
+def game_from_state(state):
+    """Restore a game of any kind
+
+    :param state: dict made by get_state of ChaosGame or IFS
+    :return: game object
+    """
+    return GAMES[state.get('kind', 'chaos')].from_state(state)
+
+
+class CryptoSource:
+    """CryptoSource class
+
+    This class is a random source backed by the operating system like the secrets module, but it makes numbers in
+    blocks. It can not be seeded.
+    """
+    @staticmethod
+    def random(size):
+        """Floats in [0, 1)
+
+        :param size: shape of the result
+        :return: array of floats
+        """
+        count = int(np.prod(size))
+        bits = np.frombuffer(os.urandom(8 * count), dtype=np.uint64) >> np.uint64(11)
+        return (bits * 2.0 ** -53).reshape(size)
+
+    def integers(self, n, size):
+        """Integers in [0, n)
+
+        :param n: upper bound
+        :param size: shape of the result
+        :return: array of integers
+        """
+        return (self.random(size) * n).astype(np.intp)
+
+
+RNGS = {'numpy': np.random.default_rng, 'secrets': lambda seed: CryptoSource()}
+
+
+def make_rng(kind='numpy', seed=None):
+    """Make a random source
+
+    A random source has random(size) and integers(n, size) methods like numpy.random.Generator.
+
+    :param kind: 'numpy' for a fast seeded generator, 'secrets' for the cryptographic one
+    :param seed: seed for the numpy generator
+    :return: random source
+    """
+    if kind not in RNGS:
+        raise ValueError('unknown random source {}'.format(kind))
+    if kind == 'secrets' and seed is not None:
+        raise ValueError('secrets source can not be seeded')
+    return RNGS[kind](seed)
+
+
+def polygon(n, radius=1.0, centre=(0.0, 0.0), angle=0.0):
+    """Vertexes of a regular polygon
+
+    :param n: number of vertexes
+    :param radius: distance from the centre to the vertexes
+    :param centre: (x, y) pair of the centre
+    :param angle: rotation in radians, 0 puts the first vertex straight up
+    :return: list of (x, y) tuples
+    """
+    phi = angle - np.pi / 2 + 2 * np.pi * np.arange(n) / n
+    return list(zip((centre[0] + radius * np.cos(phi)).tolist(), (centre[1] + radius * np.sin(phi)).tolist()))
+
+
+def rng_state(rng):
+    """State of a random source as plain data
+
+    :param rng: random source made by make_rng
+    :return: dict
+    """
+    if isinstance(rng, CryptoSource):
+        return {'kind': 'secrets'}
+    if isinstance(rng, np.random.Generator):
+        return {'kind': 'numpy', 'state': rng.bit_generator.state}
+    raise ValueError('state of {} can not be saved'.format(type(rng).__name__))
+
+
+def rng_from_state(state):
+    """Restore a random source
+
+    :param state: dict made by rng_state
+    :return: random source
+    """
+    if state['kind'] == 'secrets':
+        return CryptoSource()
+    bit_generator = getattr(np.random, state['state']['bit_generator'])()
+    bit_generator.state = state['state']
+    return np.random.Generator(bit_generator)
+
+
+def chaos_game(vertexes, allowed, relation, count, seed=None, start=None, rng='numpy'):
+    """Run the Chaos Game on plain data
+
+    :param vertexes: sequence of (x, y) pairs with coordinates of the vertexes
+    :param allowed: is a list of allowed gaps between the previously chosen vertex and currently chosen one
+    :param relation: relation ratio
+    :param count: number of points to calculate
+    :param seed: seed for the random generator
+    :param start: (x, y) pair of the initial point, the centre of the vertexes by default
+    :param rng: kind of the random source, see make_rng
+    :return: arrays of x coords, y coords and chosen vertexes
+    """
+    game = ChaosGame(vertexes, allowed, float(relation), rng=make_rng(rng, seed))
+    if start is not None:
+        game.reset(start[0], start[1])
+    return game.next_batch(count)
+
+
+def transitions(legal):
+    """Build a transition table
+
+    States of the rules are numbers of the last chosen vertexes written in base n, the latest one as the lowest digit.
+    Choosing vertex j in state s moves to state (s*n + j) mod the number of states.
+
+    :param legal: boolean array with a row per state and a column per vertex, legal[s, j] tells if vertex j may be
+        chosen in state s
+    :return: table with the states after the allowed vertexes in every state in its first columns, and their numbers
+    """
+    states, n = legal.shape
+    degree = legal.sum(axis=1)
+    order = np.argsort(~legal, axis=1, kind='stable')
+    table = (np.arange(states)[:, None] * n + order) % states
+    return table.astype(np.min_scalar_type(states)), degree
+
+
+def compile_rules(n, allowed, rule=None, order=1):
+    """Compile rules into a finite state machine
+
+    :param n: number of vertexes
+    :param allowed: is a list of allowed gaps between the previously chosen vertex and currently chosen one
+    :param rule: function rule(history, vertex, n), see ChaosGame, None for the gaps only
+    :param order: number of last vertexes the rule looks at
+    :return: boolean array legal[s, j] for every state s and vertex j, see transitions
+    """
+    states = n ** order
+    ar = np.arange(n)
+    legal = np.isin(np.abs(np.arange(states)[:, None] % n - ar[None, :]), allowed)
+    if rule is not None:
+        for state in range(states):
+            history = tuple(state // n ** k % n for k in reversed(range(order)))
+            legal[state] &= [bool(rule(history, v, n)) for v in range(n)]
+    return legal
+
+
+def neighbours(i, j, n):
+    """Tell if two vertexes are next to each other around the polygon"""
+    return (i - j) % n in (1, n - 1)
+
+
+# Rules of higher order: name -> (rule(history, vertex, n), order)
+RULES = {
+    # the same vertex can not be chosen twice in a row
+    'no-repeat': (lambda h, v, n: v != h[-1], 1),
+    # the vertex chosen two steps back can not be chosen again
+    'no-return': (lambda h, v, n: v != h[-2], 2),
+    # after the same vertex twice in a row its neighbours can not be chosen
+    'repeat-not-neighbour': (lambda h, v, n: h[-1] != h[-2] or not neighbours(v, h[-1], n), 2),
+    # the same vertex can not be chosen three times in a row
+    'no-triple': (lambda h, v, n: not (v == h[-1] == h[-2]), 2),
+}
+
+
+def walk(table, degree, u, start, states=None):
+    """Walk a finite state machine driven by random numbers
+
+    In state s the step with random number u goes to table[s, int(degree[s] * u)]. The steps are split into blocks
+    which are first followed side by side from every state the machine can be in, to find where each block ends for
+    every initial state. Orbits from different states which meet go on together, so they are merged now and then and
+    soon only a few of them are left to follow. Then the end of every block is known from its initial state, and all
+    blocks are walked side by side once more from their real initial states. Every step costs about the same however
+    many states the rules have.
+
+    :param table: 2d integer array, the states after the allowed vertexes of every state in its first columns
+    :param degree: array of the numbers of allowed vertexes of every state
+    :param u: array of random numbers from 0 to 1, one per step
+    :param start: initial state
+    :param states: array of the states which can be reached from the initial one, all of them by default
+    :return: array of states after each step
+    """
+    count = len(u)
+    if states is None:
+        states = np.arange(len(table))
+    # longer blocks for more states, so following every state costs about as much as walking the steps
+    length = max(int(np.sqrt(count)), len(states)) + 1
+    blocks = -(-count // length)
+    # the steps after the last block only pad it, the end of the last block is never used
+    padded = np.resize(u, blocks * length).reshape(blocks, length)
+    # ends[i, label[i, s]] is where block i is after its steps so far from state s
+    ends = np.tile(states, (blocks, 1))
+    label = np.zeros((blocks, len(table)), dtype=np.intp)
+    label[:, states] = np.arange(len(states))
+    for j in range(length):
+        ends = table[ends, (degree[ends] * padded[:, j, None]).astype(np.intp)]
+        if ends.shape[1] > 1 and (j + 1) & j == 0:
+            ends, label = merge_orbits(ends, label, len(table))
+    initial = np.empty(blocks, dtype=np.intp)
+    state = start
+    for i in range(blocks):
+        initial[i] = state
+        state = ends[i, label[i, state]]
+    out = np.empty((blocks, length), dtype=np.intp)
+    state = initial
+    for j in range(length):
+        state = table[state, (degree[state] * padded[:, j]).astype(np.intp)]
+        out[:, j] = state
+    return out.reshape(-1)[:count]
+
+
+def merge_orbits(ends, label, states):
+    """Merge orbits which are in the same state, see walk
+
+    :param ends: 2d array, the current states of the orbits followed in every block
+    :param label: 2d array, the orbit of every initial state in every block
+    :param states: number of states
+    :return: new ends and label, with the same orbits in every block only once
+    """
+    blocks, width = ends.shape
+    keys, inverse = np.unique(ends + np.arange(blocks)[:, None] * states, return_inverse=True)
+    row = keys // states
+    first = np.searchsorted(row, np.arange(blocks))
+    column = np.arange(len(keys)) - first[row]
+    merged = np.empty((blocks, column.max() + 1), dtype=ends.dtype)
+    merged[:] = (keys[first] % states)[:, None]
+    merged[row, column] = keys % states
+    return merged, np.take_along_axis(column[inverse.reshape(blocks, width)], label, axis=1)
+
+
+def contract(c, a):
+    """Solve a linear recurrence in place
+
+    Turns c into p where p[i] = a*p[i-1] + c[i] and p[-1] = 0. Uses a doubling scan that stops as soon as the older
+    terms are too small to change the result.
+
+    :param c: array of free terms, first axis is the step
+    :param a: coefficient, 0 < a < 1
+    :return: c
+    """
+    d, f = 1, a
+    while d < len(c) and f > 1e-17:
+        c[d:] += f * c[:-d]
+        d *= 2
+        f *= f
+    return c
+
+
+def contract_affine(m, c):
+    """Solve an affine recurrence in place
+
+    Turns c into p where p[i] = m[i] @ p[i-1] + c[i] and p[-1] = 0. Same doubling scan as contract, with the
+    products of the matrices kept in m; it stops once they are too small to change the result.
+
+    :param m: array of 2x2 matrices, first axis is the step
+    :param c: array of free terms
+    :return: c
+    """
+    (a, b), (e, f) = (m[:, 0, 0].copy(), m[:, 0, 1].copy()), (m[:, 1, 0].copy(), m[:, 1, 1].copy())
+    x, y = c[:, 0].copy(), c[:, 1].copy()
+    d = 1
+    while d < len(c) and max(np.abs(a[d:]).max(), np.abs(b[d:]).max(), np.abs(e[d:]).max(),
+                             np.abs(f[d:]).max()) > 1e-17:
+        x[d:], y[d:] = x[d:] + a[d:] * x[:-d] + b[d:] * y[:-d], y[d:] + e[d:] * x[:-d] + f[d:] * y[:-d]
+        a[d:], b[d:], e[d:], f[d:] = (a[d:] * a[:-d] + b[d:] * e[:-d], a[d:] * b[:-d] + b[d:] * f[:-d],
+                                      e[d:] * a[:-d] + f[d:] * e[:-d], e[d:] * b[:-d] + f[d:] * f[:-d])
+        d *= 2
+    c[:, 0], c[:, 1] = x, y
+    return c
@@ -0,0 +1,726 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the render stage: points are counted in a density buffer which is turned into an image in one pass.
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import os
+import copy
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import model as m
+import export
+
+TONES = ('log', 'gamma', 'linear')
+# Points of a chain counted at once
+CHUNK = 1 << 20
+# Points thrown away after a given initial point while the orbit is still off the attractor
+BURN = 100
+# Mean hits of a lit pixel needed before a finer preview level is shown
+PREVIEW_HITS = 4
+# A chunk with fewer points than the cells of a buffer divided by this updates only the hit cells
+SPARSE = 8
+# Mean hits of a lit pixel in an exact render, cells along a side of a pixel, the largest grid and the most points
+# moved without merging at the end, see subdivide
+EXACT_HITS = 256
+SUBCELLS = 2
+MAX_CELLS = 1 << 27
+TAIL_POINTS = 1 << 23
+# Change of the image between two checks under which a render is converged, points before the first check and the
+# largest grid compared, see Convergence
+CONVERGED = 0.05
+FIRST_CHECK = 1 << 16
+CHECK_CELLS = 1 << 22
+# Next counter type for a buffer whose counts do not fit any more
+WIDER = {np.dtype(np.uint8): np.uint16, np.dtype(np.uint16): np.uint32, np.dtype(np.uint32): np.uint64}
+
+
+class Density:
+    """Density class
+
+    This class accumulates points into integer hit counts, one channel per vertex. Point coordinates are mapped to
+    pixels as (x - origin) * scale, so the same orbit can be counted at any resolution. Counts start in a compact
+    type and are widened when they would overflow it. Colours are applied only when an image is made, so an image
+    can be made again with other colours without counting the points again.
+
+    :param width and height: size of the buffer in pixels
+    :param channels: number of vertexes to count separately
+    :param origin: (x, y) pair of the point that goes to the top left pixel
+    :param scale: pixels per coordinate unit
+    :param levels: number of coarser copies of the buffer for previews, each one halves the resolution, see preview
+    :param dtype: unsigned integer type the counts start with
+    """
+    def __init__(self, width, height, channels=1, origin=(0, 0), scale=1.0, levels=0, dtype=np.uint16):
+        assert width > 0 and height > 0, 'size must be positive'
+        assert channels > 0, 'there must be at least one channel'
+        assert scale > 0, 'scale must be positive'
+        self.width = width
+        self.height = height
+        self.origin = tuple(origin)
+        self.scale = scale
+        self.stats = m.Stats()
+        self.counts = np.zeros((channels, height, width), dtype=dtype)
+        self.levels = [np.zeros((channels, (height + (1 << k) - 1) >> k, (width + (1 << k) - 1) >> k),
+                                dtype=dtype) for k in range(1, levels + 1)]
+
+    @property
+    def channels(self):
+        return self.counts.shape[0]
+
+    def add(self, xs, ys, vers=None):
+        """Count points
+
+        Coordinates are rounded to the nearest pixel here. Points outside of the buffer are skipped.
+
+        :param xs and ys: arrays of coordinates
+        :param vers: array of vertexes the points were moved to, channel 0 for all of them by default
+        """
+        with self.stats.timer('rasterize'):
+            channel, row, column = self.locate(xs, ys, vers)
+            self.counts = count((channel * self.height + row) * self.width + column, self.counts)
+            for k, level in enumerate(self.levels):
+                flat = (channel * level.shape[1] + (row >> k + 1)) * level.shape[2] + (column >> k + 1)
+                self.levels[k] = count(flat, level)
+
+    def locate(self, xs, ys, vers=None):
+        """Find pixels of points
+
+        :param xs and ys: arrays of coordinates
+        :param vers: array of vertexes the points were moved to
+        :return: arrays of channels, rows and columns of the points inside of the buffer
+        """
+        xs = np.rint((np.asarray(xs, dtype=np.float64) - self.origin[0]) * self.scale)
+        ys = np.rint((np.asarray(ys, dtype=np.float64) - self.origin[1]) * self.scale)
+        inside = (0 <= xs) & (xs < self.width) & (0 <= ys) & (ys < self.height)
+        if vers is not None and self.channels > 1:
+            channel = np.asarray(vers, dtype=np.intp)[inside]
+        else:
+            channel = np.zeros(np.count_nonzero(inside), dtype=np.intp)
+        return channel, ys[inside].astype(np.intp), xs[inside].astype(np.intp)
+
+    def merge(self, other):
+        """Add hit counts and stats of another buffer of the same size
+
+        :param other: Density object
+        """
+        self.counts = widen(self.counts, int(self.counts.max()) + int(other.counts.max()))
+        self.counts += other.counts
+        for k, part in enumerate(other.levels[:len(self.levels)]):
+            self.levels[k] = widen(self.levels[k], int(self.levels[k].max()) + int(part.max()))
+            self.levels[k] += part
+        self.stats.merge(other.stats)
+
+    def close(self):
+        """Free the buffer"""
+
+    def total(self):
+        """Hit counts of all channels together
+
+        :return: 2d array of counts
+        """
+        return self.counts.sum(axis=0, dtype=np.uint64)
+
+    def intensity(self, tone='log', gamma=1.0):
+        """Tone-map hit counts
+
+        :param tone: 'log' for logarithmic density, 'gamma' or 'linear' for counts relative to the maximum
+        :param gamma: gamma applied after the tone curve
+        :return: 2d array of floats in [0, 1]
+        """
+        return tone_map(self.total(), tone, gamma)
+
+    def image(self, colors=None, tone='log', gamma=1.0, alpha=False):
+        """Make an image
+
+        Colour of a pixel is the mix of the vertex colours weighted by hit counts, brightness is the tone-mapped
+        density.
+
+        :param colors: (r, g, b) colour for every channel, white by default
+        :param tone: tone curve, see intensity
+        :param gamma: gamma applied after the tone curve
+        :param alpha: if True the brightness goes into an alpha channel and colours stay at full strength
+        :return: uint8 array of shape (height, width, 3), or (height, width, 4) with alpha
+        """
+        return colorize(self.counts, colors, tone, gamma, alpha)
+
+    def preview(self, colors=None, tone='log', gamma=1.0, alpha=False):
+        """Make an image good enough for the points counted so far
+
+        Few points make a noisy image at full resolution, so the finest level whose lit pixels have PREVIEW_HITS hits
+        on average is shown, blown up to the size of the buffer. Levels are counted along with the buffer, so nothing
+        is recomputed here.
+
+        :return: uint8 array like image
+
+        See image for the parameters.
+        """
+        choices = [self.counts] + self.levels
+        points = int(choices[-1].sum(dtype=np.uint64))
+        best = len(choices) - 1
+        for k in reversed(range(best)):
+            if points < PREVIEW_HITS * np.count_nonzero(choices[k].any(axis=0)):
+                break
+            best = k
+        out = colorize(choices[best], colors, tone, gamma, alpha)
+        if best:
+            out = np.ascontiguousarray(out.repeat(1 << best, axis=0).repeat(1 << best, axis=1)[:self.height,
+                                                                                               :self.width])
+        return out
+
+    def bands(self, colors=None, tone='log', gamma=1.0):
+        """Make an image in bands of rows
+
+        :return: generator of uint8 arrays of shape (rows, width, 3)
+
+        See image for the parameters.
+        """
+        yield self.image(colors, tone, gamma)
+
+    def save(self, path, colors=None, tone='log', gamma=1.0):
+        """Write the image to a file
+
+        :param path: path of the file, see export.open_image for the formats
+
+        See image for the other parameters.
+        """
+        with export.open_image(path, self.width, self.height) as out:
+            for rows in self.bands(colors, tone, gamma):
+                out.write(rows)
+
+
+class TiledDensity(Density):
+    """TiledDensity class
+
+    This class is a Density kept in a memory-mapped file and processed in bands of rows, so its size is bounded by the
+    disk rather than by memory. It can be pickled: only the path of the file is sent, and the file is removed by
+    close.
+
+    :param band: number of rows in a band
+    :param directory: directory of the buffer file, the temporary one by default
+
+    See Density for the other parameters.
+    """
+    def __init__(self, width, height, channels=1, origin=(0, 0), scale=1.0, band=256, directory=None):
+        assert width > 0 and height > 0, 'size must be positive'
+        assert channels > 0, 'there must be at least one channel'
+        assert scale > 0, 'scale must be positive'
+        self.width = width
+        self.height = height
+        self.origin = tuple(origin)
+        self.scale = scale
+        self.stats = m.Stats()
+        self.band = band
+        self.levels = []
+        handle, self.path = tempfile.mkstemp(suffix='.density', dir=directory)
+        os.close(handle)
+        self.counts = np.memmap(self.path, dtype=np.uint32, mode='w+', shape=(channels, height, width))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['counts'] = self.counts.shape
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.counts = np.memmap(self.path, dtype=np.uint32, mode='r+', shape=state['counts'])
+
+    def add(self, xs, ys, vers=None):
+        with self.stats.timer('rasterize'):
+            self.__add(xs, ys, vers)
+
+    def __add(self, xs, ys, vers):
+        channel, row, column = self.locate(xs, ys, vers)
+        band = row // self.band
+        order = np.argsort(band, kind='stable')
+        channel, row, column, band = channel[order], row[order], column[order], band[order]
+        edges = np.searchsorted(band, np.arange(-(-self.height // self.band) + 1))
+        cells = self.counts.reshape(-1)
+        for i in np.flatnonzero(np.diff(edges)):
+            top = i * self.band
+            part = slice(edges[i], edges[i + 1])
+            rows = min(self.band, self.height - top)
+            if (edges[i + 1] - edges[i]) * SPARSE < self.channels * rows * self.width:
+                # few points in the band: only the hit cells are read and written
+                index, hits = np.unique((channel[part] * self.height + row[part]) * self.width + column[part],
+                                        return_counts=True)
+                new = cells[index]
+                saturate(new, hits)
+                cells[index] = new
+            else:
+                flat = (channel[part] * rows + row[part] - top) * self.width + column[part]
+                hits = np.bincount(flat, minlength=self.channels * rows * self.width)
+                saturate(self.counts[:, top:top + rows], hits.reshape(self.channels, rows, self.width))
+
+    def merge(self, other):
+        for top in range(0, self.height, self.band):
+            saturate(self.counts[:, top:top + self.band], other.counts[:, top:top + self.band])
+        self.stats.merge(other.stats)
+
+    def close(self):
+        """Remove the buffer file"""
+        if os.path.exists(self.path):
+            del self.counts
+            os.remove(self.path)
+
+    def total(self):
+        return np.concatenate([self.counts[:, top:top + self.band].sum(axis=0, dtype=np.uint64)
+                               for top in range(0, self.height, self.band)])
+
+    def top(self):
+        """Largest hit count of all channels together
+
+        :return: integer
+        """
+        return max(int(self.counts[:, top:top + self.band].sum(axis=0, dtype=np.uint64).max())
+                   for top in range(0, self.height, self.band))
+
+    def image(self, colors=None, tone='log', gamma=1.0, alpha=False):
+        top = self.top()
+        return np.concatenate([colorize(self.counts[:, i:i + self.band], colors, tone, gamma, alpha, top)
+                               for i in range(0, self.height, self.band)])
+
+    def bands(self, colors=None, tone='log', gamma=1.0):
+        top = self.top()
+        for i in range(0, self.height, self.band):
+            yield colorize(self.counts[:, i:i + self.band], colors, tone, gamma, top=top)
+
+
+class Convergence:
+    """Convergence class
+
+    This class watches a density buffer while points are counted and tells when its image has stopped changing. The
+    buffer is checked every time the number of points has doubled. At a check the share of the lit pixels that were
+    dark at the previous check, and the part of the total hits that moved between pixels since then, are measured.
+    The render is converged when both are below the tolerance. Large buffers are compared in blocks of pixels and read
+    in bands of rows, so a check never takes more than a few times CHECK_CELLS cells of memory.
+
+    :param density: Density or TiledDensity object
+    :param tol: tolerance of both measures
+    :param done: number of points already in the buffer
+    """
+    def __init__(self, density, tol=CONVERGED, done=0):
+        assert tol > 0, 'tolerance must be positive'
+        self.density = density
+        self.tol = tol
+        self.done = done
+        self.next = max(FIRST_CHECK, 2 * done)
+        self.block = int(np.ceil(np.sqrt(density.width * density.height / CHECK_CELLS)))
+        self.change = self.fresh = None
+        self.points = None
+        self.__last = None
+
+    @property
+    def converged(self):
+        return self.points is not None
+
+    def update(self, count):
+        """Count new points and check the buffer when it is due
+
+        :param count: number of points added to the buffer since the last call
+        :return: True once the render is converged
+        """
+        self.done += count
+        if self.converged or self.done < self.next:
+            return self.converged
+        self.next = 2 * self.done
+        hits = self.blocks()
+        hits = hits.astype(np.float64) / max(1, hits.sum())
+        if self.__last is not None:
+            lit = np.count_nonzero(hits)
+            self.fresh = np.count_nonzero(hits[self.__last == 0]) / max(1, lit)
+            self.change = np.abs(hits - self.__last).sum() / 2
+            if self.change < self.tol and self.fresh < self.tol:
+                self.points = self.done
+        self.__last = hits.astype(np.float32)
+        return self.converged
+
+    def blocks(self):
+        """Hit counts of all channels together summed over blocks of pixels
+
+        :return: 2d array of counts
+        """
+        width, block = self.density.width, self.block
+        step = block * max(1, CHECK_CELLS // (width * block))
+        columns = np.arange(0, width, block)
+        return np.concatenate([np.add.reduceat(np.add.reduceat(
+            self.density.counts[:, top:top + step].sum(axis=0, dtype=np.uint64),
+            np.arange(0, min(step, self.density.height - top), block), axis=0), columns, axis=1)
+            for top in range(0, self.density.height, step)])
+
+    def __str__(self):
+        if self.change is None:
+            return 'converging'
+        state = 'converged at {:,} pts'.format(self.points) if self.converged else 'converging'
+        return '{} | change {:.1%} new {:.1%}'.format(state, self.change, self.fresh)
+
+
+def count(flat, buffer):
+    """Count hits into a buffer
+
+    :param flat: array of flat indexes of the hit cells
+    :param buffer: contiguous array of counts
+    :return: buffer, a wider copy of it if the counts did not fit
+    """
+    cells = buffer.reshape(-1)
+    if len(flat) * SPARSE < buffer.size:
+        index, hits = np.unique(flat, return_counts=True)
+        new = cells[index] + hits
+        buffer = widen(buffer, int(new.max()) if len(new) else 0)
+        buffer.reshape(-1)[index] = new
+    else:
+        hits = np.bincount(flat, minlength=buffer.size)
+        buffer = widen(buffer, int(cells.max()) + int(hits.max()))
+        buffer += hits.reshape(buffer.shape).astype(buffer.dtype)
+    return buffer
+
+
+def widen(buffer, peak):
+    """Make sure a buffer can hold a count
+
+    :param buffer: array of counts
+    :param peak: largest count the buffer has to hold
+    :return: buffer, or a copy of it in a wider type
+    """
+    while peak > np.iinfo(buffer.dtype).max and buffer.dtype in WIDER:
+        buffer = buffer.astype(WIDER[buffer.dtype])
+    return buffer
+
+
+def saturate(counts, hits):
+    """Add hits to counts which can not be widened, in place
+
+    Counts which would not fit stop at the largest value of their type instead of wrapping around.
+
+    :param counts: array of counts
+    :param hits: array of hits of the same shape
+    """
+    top = np.iinfo(counts.dtype).max
+    if not counts.size or int(counts.max()) + int(hits.max()) <= top:
+        counts += hits.astype(counts.dtype)
+    else:
+        counts[...] = np.minimum(counts.astype(np.uint64) + hits, top)
+
+
+def colorize(counts, colors=None, tone='log', gamma=1.0, alpha=False, top=None):
+    """Make an image of hit counts
+
+    :param counts: array of hit counts of shape (channels, height, width)
+    :param top: hit count that gets full brightness, the largest one by default
+    :return: uint8 array of shape (height, width, 3), or (height, width, 4) with alpha
+
+    See Density.image for the other parameters.
+    """
+    channels = counts.shape[0]
+    if colors is None:
+        colors = [(255, 255, 255)] * channels
+    colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+    assert len(colors) >= channels, 'a colour is required for every channel'
+    total = counts.sum(axis=0, dtype=np.uint64)
+    level = tone_map(total, tone, gamma, top)
+    if channels == 1:
+        rgb = np.broadcast_to(colors[0], total.shape + (3,))
+    else:
+        rgb = np.tensordot(counts, colors[:channels], axes=(0, 0))
+        rgb /= np.maximum(total, 1)[..., None]
+    if alpha:
+        out = np.empty(total.shape + (4,), dtype=np.uint8)
+        out[..., :3] = rgb
+        out[..., 3] = level * 255
+        return out
+    return (rgb * level[..., None]).astype(np.uint8)
+
+
+def tone_map(counts, tone='log', gamma=1.0, top=None):
+    """Map hit counts to brightness
+
+    :param counts: array of hit counts
+    :param tone: 'log', 'gamma' or 'linear'
+    :param gamma: gamma applied after the tone curve
+    :param top: hit count that gets full brightness, the largest one by default
+    :return: array of floats in [0, 1]
+    """
+    if tone not in TONES:
+        raise ValueError('unknown tone {}'.format(tone))
+    if top is None:
+        top = counts.max() if counts.size else 0
+    top = float(top)
+    if top == 0:
+        return np.zeros(counts.shape)
+    if tone == 'log':
+        level = np.log1p(counts) / np.log1p(top)
+    else:
+        level = counts / top
+    if gamma != 1.0:
+        level **= 1 / gamma
+    return level
+
+
+def make_game(vertexes, allowed, relation, seed=None, start=None, burn=BURN, rng='numpy', maps=None, rule=None):
+    """Make a game ready to be counted
+
+    :param vertexes: sequence of (x, y) pairs with coordinates of the vertexes
+    :param allowed: is a list of allowed gaps between the previously chosen vertex and currently chosen one
+    :param relation: relation ratio
+    :param seed: seed for the random generator
+    :param start: (x, y) pair of the initial point, by default the game starts on the attractor, see
+        model.ChaosGame.settle
+    :param burn: number of points to throw away after the given initial point
+    :param rng: kind of the random source, see model.make_rng
+    :param maps: maps of a model.IFS to run instead of the Chaos Game; vertexes, allowed and relation are unused then
+    :param rule: name of a rule of higher order, see model.RULES
+    :return: model.ChaosGame or model.IFS object
+    """
+    if maps is not None:
+        game = m.IFS(maps, rng=m.make_rng(rng, seed))
+    else:
+        game = m.ChaosGame(vertexes, allowed, float(relation), rng=m.make_rng(rng, seed), rule=rule)
+    if start is None:
+        game.settle()
+    else:
+        game.reset(start[0], start[1])
+        game.next_batch(burn)
+    return game
+
+
+def fit(game, width, height, margin=0.02, sample=1 << 16):
+    """Find a mapping of coordinates to pixels that fits the attractor
+
+    The game is not changed: the sample is taken from a copy of it.
+
+    :param game: game object
+    :param width and height: size of the image
+    :param margin: part of the image left empty around the attractor
+    :param sample: number of points to measure the attractor with
+    :return: origin and scale, see Density
+    """
+    xs, ys, _ = copy.deepcopy(game).next_batch(sample)
+    low, high = np.array([xs.min(), ys.min()]), np.array([xs.max(), ys.max()])
+    size = np.maximum(high - low, 1e-12)
+    scale = float(min((1 - 2 * margin) * width / size[0], (1 - 2 * margin) * height / size[1]))
+    centre = (low + high) / 2
+    origin = centre - np.array([width, height]) / 2 / scale
+    return tuple(origin.tolist()), scale
+
+
+def render_chain(vertexes, allowed, relation, count, width, height, channels=1, seed=None, start=None, burn=BURN,
+                 rng='numpy', origin=(0, 0), scale=1.0, band=None, maps=None, rule=None):
+    """Render one chain
+
+    :param count: number of points to count
+    :param width and height: size of the buffer in pixels
+    :param channels: number of channels of the buffer, see Density
+    :param origin and scale: mapping of coordinates to pixels, see Density
+    :param band: rows in a band of a TiledDensity, None for a Density in memory
+    :return: Density or TiledDensity object
+
+    See make_game for the other parameters.
+    """
+    game = make_game(vertexes, allowed, relation, seed, start, burn, rng, maps, rule)
+    density = make_density(width, height, channels, origin, scale, band)
+    game.stats = density.stats
+    try:
+        accumulate(game, density, count)
+    except BaseException:
+        density.close()
+        raise
+    return density
+
+
+def accumulate(game, density, count, callback=None, convergence=None):
+    """Count points of a game into a density buffer
+
+    :param game: model.ChaosGame object, goes on from its current state
+    :param density: Density or TiledDensity object
+    :param count: number of points
+    :param callback: function called with the number of points counted so far after every chunk
+    :param convergence: Convergence object of the buffer to stop early once the image has stopped changing
+    :return: number of points counted
+    """
+    for done in range(0, count, CHUNK):
+        n = min(CHUNK, count - done)
+        density.add(*game.next_batch(n))
+        if callback is not None:
+            callback(done + n)
+        if convergence is not None and convergence.update(n):
+            return done + n
+    return count
+
+
+def subdivide(game, density, points=None, cells=SUBCELLS):
+    """Render the attractor of a game without randomness
+
+    The probability of every state of the rules is kept on a grid of cells finer than the pixels. Starting from a
+    point of the attractor, every allowed move is applied to every occupied cell, level by level. After every level the
+    points which fell into the same cell of the same state are merged: their probabilities are added up and one of them
+    is kept. Kept points are images of the first one, so they lie on the attractor and light only pixels which the
+    random walk lights too. Levels go on until the moves shrink the whole attractor below a cell, and then a few more
+    without merging while the moves branch and there are at most TAIL_POINTS points, which brings back the detail lost
+    in the merged cells. Then the probabilities are counted as hits, a pixel whose share of the hits rounds to zero
+    stays dark as it would after as many random points. Preview levels of the buffer are not updated.
+
+    :param game: model.ChaosGame object, its rules are used and the game itself is not changed
+    :param density: density buffer to add the hits to
+    :param points: total of the hits, EXACT_HITS per pixel with some probability by default
+    :param cells: cells along a side of a pixel
+    :return: number of moves applied
+    """
+    if not isinstance(game, m.ChaosGame) or isinstance(game, m.IFS):
+        raise ValueError('exact rendering works with the Chaos Game only')
+    with density.stats.timer('subdivide'):
+        game = copy.deepcopy(game)
+        game.settle()
+        a = 1 / (1 + game.relation)
+        # cell coordinates: pixel k covers cells from k*cells to (k + 1)*cells, as points are rounded in Density
+        to_cells = lambda xy: ((np.asarray(xy) - density.origin) * density.scale + 0.5) * cells
+        corners = to_cells(game.vertexes)
+        low = np.floor(corners.min(axis=0)).astype(np.int64) - 1
+        shape = (len(game.legal),) + tuple((np.ceil(corners.max(axis=0)).astype(np.int64) - low + 2)[::-1])
+        size = int(np.prod(shape, dtype=np.float64))
+        if size > MAX_CELLS:
+            raise ValueError('the attractor is too large for an exact render at this scale')
+        corners -= low
+        diameter = np.hypot(*np.ptp(corners, axis=0))
+        levels = int(np.ceil(np.log(1 / diameter) / np.log(a))) + 1 if diameter > 1 else 1
+        state, xy, mass = np.array([game.state]), to_cells(game.position)[None, :] - low, np.ones(1)
+        done = 0
+        for level in range(levels + 1):
+            # merge the points of every cell into one of them
+            x = np.clip(np.floor(xy[:, 0]).astype(np.int64), 0, shape[2] - 1)
+            y = np.clip(np.floor(xy[:, 1]).astype(np.int64), 0, shape[1] - 1)
+            keys = (state * shape[1] + y) * shape[2] + x
+            if len(keys) * SPARSE < size:
+                _, kept, inverse = np.unique(keys, return_index=True, return_inverse=True)
+                mass = np.bincount(inverse.reshape(-1), mass)
+            else:
+                weights = np.bincount(keys, mass, size)
+                index = np.full(size, -1, dtype=np.intp)
+                index[keys] = np.arange(len(keys))
+                kept = index[index >= 0]
+                mass = weights[keys[kept]]
+            keep = mass > 0
+            state, xy, mass = state[kept[keep]], xy[kept[keep]], mass[keep]
+            if level == levels:
+                break
+            state, xy, mass = move(game, a, corners, state, xy, mass)
+            done += len(state)
+        # without merging only branching moves add detail, and they stop once there would be too many points
+        while len(state) < int(game.degree[state].sum()) <= TAIL_POINTS:
+            state, xy, mass = move(game, a, corners, state, xy, mass)
+            done += len(state)
+        row, column = np.floor((xy[:, ::-1] + low[::-1]) / cells).astype(np.int64).T
+        inside = (0 <= row) & (row < density.height) & (0 <= column) & (column < density.width)
+        channel = state % len(game.vertexes) if density.channels > 1 else np.zeros_like(state)
+        flat = ((channel * density.height + row) * density.width + column)[inside]
+        keys, inverse = np.unique(flat, return_inverse=True)
+        mass = np.bincount(inverse.reshape(-1), mass[inside])
+        if points is None:
+            points = EXACT_HITS * len(np.unique(keys % (density.height * density.width)))
+        hits = np.rint(mass / max(mass.sum(), 1e-300) * points).astype(np.uint64)
+        keys, hits = keys[hits > 0], hits[hits > 0]
+        if len(keys) and not isinstance(density.counts, np.memmap):
+            density.counts = widen(density.counts, int((density.counts.reshape(-1)[keys] + hits).max()))
+        density.counts.reshape(-1)[keys] += hits.astype(density.counts.dtype)
+    density.stats.add(done, 0)
+    return done
+
+
+def move(game, a, corners, state, xy, mass):
+    """Apply every allowed move to every point, see subdivide
+
+    :param game: model.ChaosGame object with the rules
+    :param a: share of the way that is left after a move
+    :param corners: array of the vertexes in cell coordinates
+    :param state, xy and mass: arrays of states, cell coordinates and probabilities of the points
+    :return: the same arrays of the moved points
+    """
+    point, vertex = np.nonzero(game.legal[state])
+    return (game.moves[state[point], vertex], a * xy[point] + (1 - a) * corners[vertex],
+            mass[point] / game.degree[state[point]])
+
+
+def render_chains(vertexes, allowed, relation, count, width, height, channels=1, seed=None, start=None, burn=BURN,
+                  rng='numpy', origin=(0, 0), scale=1.0, band=None, maps=None, rule=None, chains=1, workers=None):
+    """Render with independent chains
+
+    The orbit forgets its initial point after a few dozen steps, so a render can be split into chains with their own
+    seeds which run on a process pool. Every process counts its share of the chains into one buffer, and the buffers
+    are summed as they come back, so there are never more buffers than processes.
+
+    :param chains: number of chains
+    :param workers: number of processes, one per CPU by default
+    :return: Density or TiledDensity object
+
+    See render_chain for the other parameters.
+    """
+    assert chains > 0, 'there must be at least one chain'
+    if maps is None:
+        m.ChaosGame(vertexes, allowed, float(relation), rule=rule).check(0)
+    if rng != 'numpy':
+        seeds = [None] * chains
+    elif chains == 1:
+        seeds = [seed]
+    else:
+        seeds = np.random.SeedSequence(seed).spawn(chains)
+    tasks = [(vertexes, allowed, relation, count // chains + (i < count % chains), width, height, channels,
+              seeds[i], start, burn, rng, origin, scale, band, maps, rule) for i in range(chains)]
+    if chains == 1:
+        return render_chain(*tasks[0])
+    shares = min(chains, workers or os.cpu_count() or 1)
+    density = make_density(width, height, channels, origin, scale, band)
+    finished = pending = set()
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            pending = {pool.submit(render_share, tasks[i::shares]) for i in range(shares)}
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                while finished:
+                    part = finished.pop().result()
+                    density.merge(part)
+                    part.close()
+                # a merged buffer is not kept alive while the next ones are waited for
+                del part
+    except BaseException:
+        # the buffers of the shares which are not merged yet are removed as well, finished ones included
+        for future in finished | pending:
+            if not future.cancel() and future.exception() is None:
+                future.result().close()
+        density.close()
+        raise
+    return density
+
+
+def render_share(tasks):
+    """Render several chains into one buffer
+
+    :param tasks: list of tuples of render_chain arguments, all with the same buffer parameters
+    :return: Density or TiledDensity object
+    """
+    density = None
+    try:
+        for (vertexes, allowed, relation, count, width, height, channels, seed, start, burn, rng, origin, scale,
+             band, maps, rule) in tasks:
+            if density is None:
+                density = make_density(width, height, channels, origin, scale, band)
+            game = make_game(vertexes, allowed, relation, seed, start, burn, rng, maps, rule)
+            game.stats = density.stats
+            accumulate(game, density, count)
+    except BaseException:
+        if density is not None:
+            density.close()
+        raise
+    return density
+
+
+def make_density(width, height, channels=1, origin=(0, 0), scale=1.0, band=None, dtype=np.uint16):
+    """Make a density buffer
+
+    :param band: rows in a band of a TiledDensity, None for a Density in memory
+    :param dtype: type of the counts of a Density, a TiledDensity always counts in uint32
+    :return: Density or TiledDensity object
+
+    See Density for the other parameters.
+    """
+    if band is None:
+        return Density(width, height, channels, origin, scale, dtype=dtype)
+    return TiledDensity(width, height, channels, origin, scale, band)
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains a render server: a small HTTP service over the render stage, built on asyncio and the standard
+library only.
+
+    python server.py --port 8000 --workers 4 --cache render-cache
+
+POST /render with a JSON job starts a render, or joins the same render if it is already running:
+
+    {"vertexes": [[0, 0], [400, 0], [200, 346]], "allowed": [0, 1, 2], "ratio": "1:1", "count": 1000000,
+     "size": [401, 347], "seed": 1}
+
+The answer has the key of the job. GET /jobs/<key> streams its progress as lines of JSON until it is finished, and
+GET /images/<key>.png serves the image. A failed job can be followed with its error until it is submitted again or
+FAILED newer jobs have failed. Images are kept in a cache directory under a hash of the job, the least recently used
+ones are removed when it gets too big.
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import asyncio
+import threading
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import model as m
+import render
+from cli import parse_ratio
+
+# Bumped when the renderer changes its pixels, so older cache entries are not reused
+VERSION = 2
+# Jobs queued or running at once, more are refused until some of them finish
+QUEUE = 64
+# Failed jobs kept for clients that follow them, the oldest ones are forgotten
+FAILED = 256
+# Largest number of points and of buffer cells of a job
+MAX_POINTS = 10 ** 10
+MAX_CELLS = 1 << 28
+# Size of the image cache in bytes
+CACHE_BYTES = 1 << 30
+# Optional fields of a job and their defaults
+DEFAULTS = {'allowed': None, 'ratio': '1:1', 'count': 100000, 'size': None, 'seed': 0, 'rule': None, 'colors': None,
+            'tone': 'log', 'gamma': 1.0}
+REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           503: 'Service Unavailable'}
+
+# Queue for (key, points) progress messages of the worker processes, set by init_worker
+progress = None
+
+
+def job_params(data):
+    """Check a job and fill in the defaults
+
+    :param data: dict from the request
+    :return: dict with all the parameters of the render
+    :raise ValueError: if the job is wrong or too big
+    """
+    if not isinstance(data, dict) or 'vertexes' not in data:
+        raise ValueError('a job is a JSON object with vertexes')
+    unknown = set(data) - set(DEFAULTS) - {'vertexes'}
+    if unknown:
+        raise ValueError('unknown fields: {}'.format(', '.join(sorted(unknown))))
+    params = dict(DEFAULTS, **data)
+    vertexes = [tuple(map(float, p)) for p in params['vertexes']]
+    if not vertexes or any(len(p) != 2 for p in vertexes):
+        raise ValueError('vertexes must be a list of [x, y] pairs')
+    n = len(vertexes)
+    allowed = list(range(n)) if params['allowed'] is None else [int(g) for g in params['allowed']]
+    count = int(params['count'])
+    if not 0 < count <= MAX_POINTS:
+        raise ValueError('count must be from 1 to {}'.format(MAX_POINTS))
+    if params['size'] is None:
+        width, height = (int(max(p[i] for p in vertexes)) + 1 for i in (0, 1))
+    else:
+        width, height = map(int, params['size'])
+    colors = None if params['colors'] is None else [tuple(map(int, c)) for c in params['colors']]
+    if colors is not None and len(colors) != n:
+        raise ValueError('there must be a colour for every vertex')
+    if colors is not None and any(len(c) != 3 or not all(0 <= v <= 255 for v in c) for c in colors):
+        raise ValueError('colours must be [r, g, b] triples from 0 to 255')
+    if not (width > 0 and height > 0 and width * height * (n if colors else 1) <= MAX_CELLS):
+        raise ValueError('size must be positive and at most {} cells'.format(MAX_CELLS))
+    if params['rule'] is not None and params['rule'] not in m.RULES:
+        raise ValueError('unknown rule {}'.format(params['rule']))
+    if params['tone'] not in render.TONES:
+        raise ValueError('tone must be one of {}'.format(', '.join(render.TONES)))
+    if not float(params['gamma']) > 0:
+        raise ValueError('gamma must be positive')
+    relation = parse_ratio(str(params['ratio']))
+    m.ChaosGame(vertexes, allowed, relation, rule=params['rule']).check(0)
+    return {'vertexes': vertexes, 'allowed': allowed, 'relation': relation, 'count': count, 'size': (width, height),
+            'seed': int(params['seed']), 'rule': params['rule'], 'colors': colors, 'tone': params['tone'],
+            'gamma': float(params['gamma'])}
+
+
+def job_key(params):
+    """Cache key of a job
+
+    :param params: dict made by job_params
+    :return: hex digest
+    """
+    data = dict(params, version=VERSION)
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:20]
+
+
+def init_worker(queue):
+    global progress
+    progress = queue
+
+
+def render_job(key, params, path):
+    """Render a job into a file, runs in a worker process
+
+    Progress is reported through the progress queue. The image is written under a temporary name first, so the
+    cache never has a broken one.
+
+    :param key: key of the job
+    :param params: dict made by job_params
+    :param path: path of the PNG file
+    """
+    progress.put((key, 0))
+    width, height = params['size']
+    game = render.make_game(params['vertexes'], params['allowed'], params['relation'], params['seed'],
+                            rule=params['rule'])
+    density = render.make_density(width, height, len(params['vertexes']) if params['colors'] else 1)
+    game.stats = density.stats
+    render.accumulate(game, density, params['count'], lambda n: progress.put((key, n)))
+    part = path[:-4] + '.part.png'
+    try:
+        density.save(part, params['colors'], params['tone'], params['gamma'])
+        os.replace(part, path)
+    except BaseException:
+        # Cache.trim never removes part files, so a failed job must not leave one
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    finally:
+        density.close()
+
+
+class Cache:
+    """Cache class
+
+    This class keeps finished images in a directory, one file per key. Every hit marks the file as used, and the files
+    used least recently are removed when the directory is over its limit.
+
+    :param directory: directory of the images
+    :param limit: size of the cache in bytes
+    """
+    def __init__(self, directory, limit=CACHE_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.limit = limit
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+    def get(self, key):
+        """Find an image
+
+        :param key: key of the job
+        :return: path of the image, None if it is not in the cache
+        """
+        if not key.isalnum():
+            return None
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def trim(self):
+        """Remove the least recently used images until the cache fits its limit, the newest one is always kept"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.png') and not name.endswith('.part.png'):
+                info = os.stat(os.path.join(self.directory, name))
+                files.append((info.st_mtime, info.st_size, name))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, name in files[:-1]:
+            if total <= self.limit:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+class Job:
+    """Job class
+
+    This class is a render shared by every client that asked for it. Waiting clients are woken on every change.
+
+    :param key: key of the job
+    :param count: number of points to render
+    :param status: 'queued', 'running', 'done' or 'failed'
+    """
+    def __init__(self, key, count, status='queued'):
+        self.key = key
+        self.count = count
+        self.points = count if status == 'done' else 0
+        self.status = status
+        self.error = None
+        self.changed = asyncio.Event()
+
+    def update(self, **changes):
+        for name, value in changes.items():
+            setattr(self, name, value)
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def event(self):
+        """State of the job as plain data"""
+        event = {'job': self.key, 'status': self.status, 'points': self.points, 'count': self.count}
+        if self.status == 'done':
+            event['image'] = '/images/{}.png'.format(self.key)
+        if self.error is not None:
+            event['error'] = self.error
+        return event
+
+
+class Server:
+    """Server class
+
+    This class answers HTTP requests and runs the jobs on a process pool. A job is identified by the hash of its
+    parameters, so identical jobs from many clients are rendered once.
+
+    :param cache: Cache object for the images
+    :param workers: number of processes, one per CPU by default
+    """
+    def __init__(self, cache, workers=None):
+        self.cache = cache
+        self.jobs = {}
+        self.failed = OrderedDict()
+        self.queue = multiprocessing.Queue()
+        self.pool = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self.queue,))
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """Answer requests until cancelled"""
+        loop = asyncio.get_running_loop()
+        reader = threading.Thread(target=self.read_progress, args=(loop,), daemon=True)
+        reader.start()
+        try:
+            server = await asyncio.start_server(self.handle, host, port)
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            self.queue.put((None, 0))
+            reader.join()
+
+    def read_progress(self, loop):
+        """Pass progress messages of the workers to the event loop, runs in its own thread"""
+        while True:
+            key, points = self.queue.get()
+            if key is None:
+                return
+            loop.call_soon_threadsafe(self.advance, key, points)
+
+    def advance(self, key, points):
+        job = self.jobs.get(key)
+        if job is not None and job.status in ('queued', 'running'):
+            job.update(status='running', points=points)
+
+    def submit(self, params):
+        """Start a job or find the same one
+
+        :param params: dict made by job_params
+        :return: Job object, None if the queue is full
+        """
+        key = job_key(params)
+        # a job that failed before is tried again
+        self.failed.pop(key, None)
+        if key in self.jobs:
+            return self.jobs[key]
+        if self.cache.get(key) is not None:
+            return Job(key, params['count'], 'done')
+        if len(self.jobs) >= QUEUE:
+            return None
+        job = self.jobs[key] = Job(key, params['count'])
+        asyncio.ensure_future(self.run(job, params))
+        return job
+
+    async def run(self, job, params):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.pool, render_job, job.key, params, self.cache.path(job.key))
+        except Exception as e:
+            job.update(status='failed', error='{}: {}'.format(type(e).__name__, e))
+            self.failed[job.key] = job
+            while len(self.failed) > FAILED:
+                self.failed.popitem(last=False)
+        else:
+            self.cache.trim()
+            job.update(status='done', points=job.count)
+        finally:
+            del self.jobs[job.key]
+
+    async def handle(self, reader, writer):
+        """Answer one request"""
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            await self.route(method, target.split('?')[0], body, writer)
+        except (ValueError, asyncio.IncompleteReadError):
+            await respond(writer, 400, {'error': 'malformed request'})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, body, writer):
+        if target == '/render':
+            if method != 'POST':
+                return await respond(writer, 405, {'error': 'use POST'})
+            try:
+                params = job_params(json.loads(body or b'null'))
+            except (ValueError, TypeError, KeyError) as e:
+                return await respond(writer, 400, {'error': str(e)})
+            job = self.submit(params)
+            if job is None:
+                return await respond(writer, 503, {'error': 'too many jobs, try again later'})
+            event = job.event()
+            event['progress'] = '/jobs/{}'.format(job.key)
+            return await respond(writer, 200 if job.status == 'done' else 202, event)
+        if target.startswith('/jobs/'):
+            key = target[len('/jobs/'):]
+            job = self.jobs.get(key) or self.failed.get(key)
+            if job is None:
+                if self.cache.get(key) is None:
+                    return await respond(writer, 404, {'error': 'unknown job'})
+                job = Job(key, None, 'done')
+            return await self.stream(job, writer)
+        if target.startswith('/images/') and target.endswith('.png'):
+            path = self.cache.get(target[len('/images/'):-4])
+            if path is None:
+                return await respond(writer, 404, {'error': 'no such image'})
+            with open(path, 'rb') as f:
+                data = f.read()
+            return await respond(writer, 200, data, 'image/png')
+        await respond(writer, 404, {'error': 'not found'})
+
+    async def stream(self, job, writer):
+        """Send the progress of a job as lines of JSON until it is finished"""
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n'
+                     b'Connection: close\r\n\r\n')
+        while True:
+            changed = job.changed
+            line = json.dumps(job.event()).encode() + b'\n'
+            writer.write(b'%x\r\n%s\r\n' % (len(line), line))
+            await writer.drain()
+            if job.status in ('done', 'failed'):
+                break
+            await changed.wait()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+async def respond(writer, status, body, content_type='application/json'):
+    """Send a whole response
+
+    :param writer: asyncio stream writer
+    :param status: HTTP status code
+    :param body: bytes, or data to send as JSON
+    :param content_type: type of bytes
+    """
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+        status, REASONS[status], content_type, len(body))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve Chaos Game renders over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', default=8000, type=int, help='port to listen on')
+    parser.add_argument('--workers', default=None, type=int, help='number of processes, one per CPU by default')
+    parser.add_argument('--cache', default='render-cache', help='directory of the finished images')
+    parser.add_argument('--cache-size', default=CACHE_BYTES, type=int, help='size of the image cache in bytes')
+    args = parser.parse_args(argv)
+    server = Server(Cache(args.cache, args.cache_size), args.workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
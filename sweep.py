@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains a batch runner for sweeps of the Chaos Game parameters.
+
+A sweep spec is a JSON file with lists of values; every combination of them is rendered once on a process pool:
+
+    {"vertexes": [3, 4, 5, 6], "radii": [115], "ratios": ["1:1", "1:2"], "allowed": [null, "0,1", "1,2"],
+     "rules": [null, "no-return"], "count": 1000000, "size": 256, "seed": 1}
+
+Vertexes are regular polygons centred in the image, radii are in pixels and default to 0.45 of the size. Allowed
+gaps and ratios are written as in the GUI, null allows every gap. Rendered variants are kept in a cache directory
+under a hash of everything that changes their pixels, so running the sweep again renders only the new variants.
+All variants are put together into a contact sheet, with a JSON index of the parameters of every cell:
+
+    python sweep.py spec.json sheet.png --cache sweep-cache
+
+@author: Dyma Volodymyr Sergiyovoich
+"""
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import model as m
+import render
+import export
+from cli import parse_ratio
+
+# Bumped when the renderer changes its pixels, so older cache entries are not reused
+VERSION = 2
+# Values of a spec which are not swept
+DEFAULTS = {'count': 1000000, 'size': 256, 'seed': 0, 'tone': 'log', 'gamma': 1.0}
+# Swept lists of a spec and their defaults
+LISTS = {'vertexes': [3], 'radii': [None], 'ratios': ['1:1'], 'allowed': [None], 'rules': [None]}
+# Gap between the cells of a contact sheet in pixels, and its colour
+GAP = 2
+GAP_COLOR = 64
+
+
+def variants(spec):
+    """All variants of a sweep
+
+    :param spec: dict, see the description of the file
+    :return: list of dicts with the parameters of single renders
+    """
+    unknown = set(spec) - set(DEFAULTS) - set(LISTS)
+    if unknown:
+        raise ValueError('unknown sweep keys: {}'.format(', '.join(sorted(unknown))))
+    fixed = {k: spec.get(k, v) for k, v in DEFAULTS.items()}
+    lists = [spec.get(k, v) for k, v in LISTS.items()]
+    out = []
+    for n, radius, ratio, allowed, rule in itertools.product(*lists):
+        gaps = list(range(n)) if allowed is None else [g for g in map(int, str(allowed).split(',')) if g < n]
+        out.append(dict(fixed, vertexes=n, radius=float(radius or fixed['size'] * 0.45), ratio=ratio,
+                        relation=parse_ratio(ratio), allowed=gaps, rule=rule))
+    return out
+
+
+def key(variant):
+    """Cache key of a variant
+
+    :param variant: dict made by variants
+    :return: hex digest of the parameters which change the pixels
+    """
+    data = {k: v for k, v in variant.items() if k != 'ratio'}
+    data['version'] = VERSION
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:20]
+
+
+def render_variant(variant, path):
+    """Render one variant into the cache
+
+    The pixels are saved to a .npy file and the parameters next to it. Both are written under unique temporary names
+    first, so an interrupted job never leaves a broken entry.
+
+    :param variant: dict made by variants
+    :param path: path of the .npy file
+    :return: path
+    """
+    size = variant['size']
+    vertexes = m.polygon(variant['vertexes'], variant['radius'], (size / 2, size / 2))
+    density = render.render_chain(vertexes, variant['allowed'], variant['relation'], variant['count'], size, size,
+                                  seed=variant['seed'], rule=variant['rule'])
+    pixels = density.image(tone=variant['tone'], gamma=variant['gamma'])
+    directory = os.path.dirname(path) or None
+    handle, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(handle, 'w') as f:
+        json.dump(variant, f, indent=1)
+    os.replace(temp, path[:-4] + '.json')
+    handle, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(handle, 'wb') as f:
+        np.save(f, pixels)
+    os.replace(temp, path)
+    return path
+
+
+def run(spec, cache, workers=None):
+    """Render all variants of a sweep which are not in the cache yet
+
+    Every variant is seeded with the seed of the spec, so a variant renders the same pixels whenever it is run.
+
+    :param spec: dict, see the description of the file
+    :param cache: directory of the rendered variants
+    :param workers: number of processes, one per CPU by default
+    :return: list of (variant, path) pairs, path is None for a variant whose rules get stuck
+    """
+    os.makedirs(cache, exist_ok=True)
+    jobs = [(v, os.path.join(cache, key(v) + '.npy')) for v in variants(spec)]
+    todo, queued, failed = [], set(), set()
+    for v, path in jobs:
+        try:
+            m.ChaosGame(m.polygon(v['vertexes']), v['allowed'], v['relation'], rule=v['rule']).check(0)
+        except ValueError as e:
+            failed.add(path)
+            print('skipped {}: {}'.format(os.path.basename(path), e), file=sys.stderr)
+            continue
+        # variants which differ only in how they are written, e.g. all gaps as null and as a list, share a path
+        if not os.path.exists(path) and path not in queued:
+            queued.add(path)
+            todo.append((v, path))
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(render_variant, v, path) for v, path in todo]
+        for i, future in enumerate(futures):
+            future.result()
+            print('{}/{} rendered'.format(i + 1, len(futures)), file=sys.stderr)
+    return [(v, None if path in failed else path) for v, path in jobs]
+
+
+def contact_sheet(path, results, columns=None, thumb=None):
+    """Put the rendered variants together into one image
+
+    Cells are written row by row, and an index of the parameters of every cell is saved next to the image.
+
+    :param path: path of the PNG file
+    :param results: list made by run
+    :param columns: number of cells in a row, about a square sheet by default
+    :param thumb: size of a cell in pixels, the size of the renders by default. It should divide the render size,
+        every pixel of a cell is the brightest one of its block
+    """
+    size = max(v['size'] for v, _ in results)
+    thumb = thumb or size
+    if thumb > size:
+        raise ValueError('cells can not be larger than the renders')
+    columns = columns or int(np.ceil(np.sqrt(len(results))))
+    rows = -(-len(results) // columns)
+    width, height = columns * (thumb + GAP) + GAP, rows * (thumb + GAP) + GAP
+    index = []
+    with export.PngWriter(path, width, height) as png:
+        png.write(np.full((GAP, width, 3), GAP_COLOR, dtype=np.uint8))
+        for r in range(rows):
+            strip = np.full((thumb + GAP, width, 3), GAP_COLOR, dtype=np.uint8)
+            for c, (variant, cell) in enumerate(results[r * columns:(r + 1) * columns]):
+                index.append(dict(variant, row=r, column=c, file=cell))
+                if cell is None:
+                    continue
+                pixels = np.load(cell)
+                k = len(pixels) // thumb
+                pixels = pixels[:thumb * k, :thumb * k].reshape(thumb, k, thumb, k, 3).max(axis=(1, 3))
+                x = GAP + c * (thumb + GAP)
+                strip[:thumb, x:x + thumb] = pixels
+            png.write(strip)
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(index, f, indent=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render a sweep of Chaos Game parameters into a contact sheet.')
+    parser.add_argument('spec', help='JSON file with the sweep')
+    parser.add_argument('output', help='PNG file for the contact sheet')
+    parser.add_argument('--cache', default='sweep-cache', help='directory of the rendered variants')
+    parser.add_argument('--workers', default=None, type=int, help='number of processes, one per CPU by default')
+    parser.add_argument('--columns', default=None, type=int, help='cells in a row of the contact sheet')
+    parser.add_argument('--thumb', default=None, type=int, help='size of a cell of the contact sheet in pixels')
+    args = parser.parse_args(argv)
+    try:
+        with open(args.spec) as f:
+            results = run(json.load(f), args.cache, args.workers)
+        contact_sheet(args.output, results, args.columns, args.thumb)
+    except ValueError as e:
+        parser.error(str(e))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
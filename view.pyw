@@ -6,21 +6,66 @@ This file contains realization of GUI for the Chaos Game method.
 
 @author: Dyma Volodymyr Sergiyovoich
 """
+import os
 import sys
-import ctypes
-from PyQt5 import QtWidgets, QtGui, QtCore, uic
-from ctypes import wintypes
+import time
+import importlib
+from PyQt5 import QtWidgets, QtGui, QtCore
 import model as m
-import data_rc
+import render
+
+# Directory of the application, gui.ui is looked for there
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Module made from gui.ui by pyuic5, used instead of parsing gui.ui on every start when it exists
+UI_MODULE = 'gui_ui'
+
+
+def set_app_id():
+    """Let Windows group the window under the app's own taskbar icon"""
+    if sys.platform != 'win32':
+        return
+    import ctypes
+    from ctypes import wintypes
+    # If you don't want using .pyw files, just rename it to the .py file and uncomment the following line
+    # ctypes.WinDLL('kernel32', use_last_error=True).SetConsoleTitleW("Developer Console")
+    lpBuffer = wintypes.LPWSTR()
+    AppUserModelID = ctypes.windll.shell32.GetCurrentProcessExplicitAppUserModelID
+    AppUserModelID(ctypes.cast(ctypes.byref(lpBuffer), wintypes.LPWSTR))
+    ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(AppUserModelID)
+
+
+def setup_ui(window):
+    """Build the widgets of the main window
+
+    Images are registered only here, when a window is made. The precompiled UI module is used if there is one, see
+    compile_ui, otherwise gui.ui is parsed.
+
+    :param window: QMainWindow to build the widgets in
+    """
+    importlib.import_module('data_rc')
+    try:
+        ui = importlib.import_module(UI_MODULE)
+    except ImportError:
+        from PyQt5 import uic
+        uic.loadUi(os.path.join(HERE, 'gui.ui'), window)
+    else:
+        ui.Ui_MainWindow().setupUi(window)
+
+
+def compile_ui():
+    """Write the precompiled UI module next to gui.ui
+
+    It has to be made again after gui.ui is changed.
+    """
+    from PyQt5 import uic
+    with open(os.path.join(HERE, UI_MODULE + '.py'), 'w', encoding='utf-8') as f:
+        uic.compileUi(os.path.join(HERE, 'gui.ui'), f, from_imports=False, resource_suffix='_rc')
 
-# If you don't want using .pyw files, just rename it to the .py file and uncomment the following line
-# ctypes.WinDLL('kernel32', use_last_error=True).SetConsoleTitleW("Developer Console")
-lpBuffer = wintypes.LPWSTR()
-AppUserModelID = ctypes.windll.shell32.GetCurrentProcessExplicitAppUserModelID
-AppUserModelID(ctypes.cast(ctypes.byref(lpBuffer), wintypes.LPWSTR))
-ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(AppUserModelID)
 
 k = 0
+FPS = 30
+# Number of coarser density levels shown while there are still few points
+PREVIEW_LEVELS = 4
 
 
 class QDot(QtWidgets.QLabel):
@@ -48,20 +93,21 @@ class QDot(QtWidgets.QLabel):
                               color: rgb(255, 255, 255);'''.format('rgb'+str(self.color.getRgb())))
 
     def mousePressEvent(self, event):
-        if self.__parent.runningFlag:
-            return
-        if event.button() == QtCore.Qt.LeftButton:
+        running = self.__parent.runningFlag
+        if event.button() == QtCore.Qt.LeftButton and not running:
             self.__move = True
         elif event.button() == QtCore.Qt.RightButton:
+            # the colour can be changed at any time, the picture is recoloured from the hit counts
             menu = QtWidgets.QMenu(self.__parent)
             action_color = QtWidgets.QAction('Color', self)
             menu.addAction(action_color)
             menu.addSeparator()
             action_delete = QtWidgets.QAction('Delete', self)
+            action_delete.setEnabled(not running)
             menu.addAction(action_delete)
             global_cursor_pos = QtGui.QCursor().pos()
-            mouse_screen = app.desktop().screenNumber(global_cursor_pos)
-            mouse_screen_geometry = app.desktop().screen(mouse_screen).geometry()
+            mouse_screen = QtWidgets.QApplication.desktop().screenNumber(global_cursor_pos)
+            mouse_screen_geometry = QtWidgets.QApplication.desktop().screen(mouse_screen).geometry()
             local_cursor_pos = global_cursor_pos - mouse_screen_geometry.topLeft()
             menu.move(local_cursor_pos)
             menu.show()
@@ -86,6 +132,7 @@ class QDot(QtWidgets.QLabel):
             self.setStyleSheet('''background-color: {};
                                   font: 7pt "Verdana";
                                   color: rgb(255, 255, 255);'''.format('rgb'+str(self.color.getRgb())))
+            self.__parent.recolor()
 
     def mouseMoveEvent(self, event):
         self.__parent.coords_label.setText("({}, {})".format(self.pos().x(), self.pos().y()))
@@ -102,6 +149,50 @@ class QDot(QtWidgets.QLabel):
             self.__parent.del_dot(self)
 
 
+class Worker(QtCore.QThread):
+    """Worker class
+
+    This thread runs the Chaos Game in chunks and sends every chunk of points to the window once per frame. A new
+    chunk is made only when the window has taken the previous one, so chunks never pile up when drawing is slower than
+    the game.
+
+    :param game: model.ChaosGame object, the game goes on from its current state
+    :param count: number of points to calculate, None to run endlessly
+    :param parent: parent of the given QObject
+    """
+    frame = QtCore.pyqtSignal(object)
+
+    def __init__(self, game, count=None, parent=None):
+        super().__init__(parent)
+        self.game = game
+        self.count = count
+        self.per_frame = 1
+        self.free = QtCore.QSemaphore(1)
+
+    def set_speed(self, value):
+        """Set points per frame
+
+        :param value: speed slider value from 1 to 100; 100 means 10^5 points per frame
+        """
+        self.per_frame = max(1, int(10 ** (value / 20)))
+
+    def taken(self):
+        """Let the next chunk be made, called by the window when it has taken a chunk"""
+        self.free.release()
+
+    def run(self):
+        while not self.isInterruptionRequested() and (self.count is None or self.count > 0):
+            if not self.free.tryAcquire(1, int(1000 / FPS)):
+                continue
+            begin = time.perf_counter()
+            n = self.per_frame if self.count is None else min(self.per_frame, self.count)
+            xs, ys, vers = self.game.next_batch(n)
+            if self.count is not None:
+                self.count -= n
+            self.frame.emit((xs, ys, vers))
+            self.msleep(max(0, int((1 / FPS - (time.perf_counter() - begin)) * 1000)))
+
+
 class GUI(QtWidgets.QMainWindow):
     """GUI class
 
@@ -112,7 +203,7 @@ class GUI(QtWidgets.QMainWindow):
     """
     def __init__(self, parent=None):
         super().__init__(parent, flags=QtCore.Qt.Window)
-        uic.loadUi('gui.ui', self)
+        setup_ui(self)
         self.textEdit.viewport().setCursor(QtGui.QCursor(QtCore.Qt.ArrowCursor))
         self.textEdit_2.viewport().setCursor(QtGui.QCursor(QtCore.Qt.ArrowCursor))
         self.textEdit_3.viewport().setCursor(QtGui.QCursor(QtCore.Qt.ArrowCursor))
@@ -126,11 +217,15 @@ class GUI(QtWidgets.QMainWindow):
         self.vertexes = dict()
         self.ver_label = QtWidgets.QLabel("Vertices: {}".format(len(self.vertexes.keys())), self)
         self.status_label = QtWidgets.QLabel("Not ready", self)
+        self.stats_label = QtWidgets.QLabel('', self)
+        self.stats_label.setStyleSheet("""color: white;
+                                           font: 10pt "Verdana";""")
         self.coords_label = QtWidgets.QLabel('', self)
         self.coords_label.setStyleSheet("""color: white;
                                            font: 10pt "Verdana";""")
         self.statusbar.addWidget(self.status_label, 2)
         self.statusbar.addWidget(self.coords_label, 1)
+        self.statusbar.addPermanentWidget(self.stats_label, 3)
         self.statusbar.addPermanentWidget(self.ver_label, 1)
         self.groupBox.prevHeight = 20
         self.ready = False
@@ -140,8 +235,10 @@ class GUI(QtWidgets.QMainWindow):
         self.pauseFlag = False
         self.runningFlag = False
         self.point = QtCore.QObject()
-        self.color = None
-        self.loop = QtCore.QEventLoop()
+        self.density = None
+        self.convergence = None
+        self.dirty = False
+        self.worker = None
         self.oImage = QtGui.QImage(":/board.png")
         self.oImage.scaled(self.width(), self.height())
         self.plt = QtGui.QPalette()
@@ -209,15 +306,22 @@ class GUI(QtWidgets.QMainWindow):
             self.vertexes[i].deleteLater()
         self.vertexes.clear()
         self.spinBox.setDisabled(False)
+        self.checkBox.setDisabled(False)
         self.lineEdit.setDisabled(False)
         self.lineEdit_2.setDisabled(False)
         self.posit = None
         self.pause()
+        if self.worker is not None:
+            self.worker.frame.disconnect()
+            self.worker.wait()
+            self.worker = None
         self.runningFlag = False
         self.point.deleteLater()
         self.point = QtCore.QObject()
-        self.color = None
-        self.loop = QtCore.QEventLoop()
+        self.density = None
+        self.convergence = None
+        self.dirty = False
+        self.stats_label.setText('')
         self.oImage = QtGui.QImage(":/board.png")
         self.plt = QtGui.QPalette()
         self.plt.setBrush(self.plt.Window, QtGui.QBrush(self.oImage))
@@ -225,19 +329,22 @@ class GUI(QtWidgets.QMainWindow):
         self.spinBox.setValue(0)
         self.end_val = 0
         self.spinBox.endless = True
-        m.prevVer1 = 0
 
     def pause(self):
         """Pause running"""
         self.pauseFlag = True
+        if self.worker is not None:
+            self.worker.requestInterruption()
         self.textEdit_4.hide()
 
     def speed_change(self):
         """Change running speed
 
-        Changes the speed of the algorithm.
+        Changes the number of points drawn per frame.
         """
         self.speed_label.setText(str(self.speed.value())+'%')
+        if self.worker is not None:
+            self.worker.set_speed(self.speed.value())
 
     def start(self):
         """Start algorithm
@@ -248,6 +355,7 @@ class GUI(QtWidgets.QMainWindow):
             return
         self.textEdit_3.hide()
         self.spinBox.setDisabled(True)
+        self.checkBox.setDisabled(True)
         self.lineEdit.setDisabled(True)
         self.lineEdit_2.setDisabled(True)
         if self.textEdit_4.first_time:
@@ -257,29 +365,64 @@ class GUI(QtWidgets.QMainWindow):
         r1, r2 = tuple(map(int, self.lineEdit_2.text().split(':')))
         relation = r1 / r2
         if isinstance(self.point, QDot):
-            if self.pauseFlag:
-                self.pauseFlag = False
-            self.loop = QtCore.QEventLoop()
-            i = -1
-            if not self.spinBox.endless:
-                i = 0
-            self.posit = self.point.pos()
+            if self.worker is not None:
+                self.worker.wait()
+                game = self.worker.game
+                if self.convergence is not None and self.convergence.converged:
+                    # the picture has converged already, so going on means the user wants more points anyway
+                    self.convergence = None
+            else:
+                vertexes = [(self.vertexes[i].x() + 4, self.vertexes[i].y() + 4) for i in sorted(self.vertexes)]
+                try:
+                    game = m.ChaosGame(vertexes, allowed_vertexes, relation)
+                    self.density = render.Density(self.width(), self.height(), len(self.vertexes),
+                                                  levels=PREVIEW_LEVELS)
+                    game.stats = self.density.stats
+                    game.reset(self.point.x() + 4, self.point.y() + 4)
+                    # points on the way from the initial point to the attractor would stay in the picture for good
+                    game.next_batch(game.transient(0.5))
+                    if self.checkBox.isChecked():
+                        self.convergence = render.Convergence(self.density)
+                except ValueError as e:
+                    QtWidgets.QMessageBox.warning(self, 'Chaos Game', str(e))
+                    self.spinBox.setDisabled(False)
+                    self.checkBox.setDisabled(False)
+                    self.lineEdit.setDisabled(False)
+                    self.lineEdit_2.setDisabled(False)
+                    return
+            self.pauseFlag = False
+            self.worker = Worker(game, None if self.spinBox.endless else self.spinBox.value(), self)
+            self.worker.set_speed(self.speed.value())
+            self.worker.frame.connect(self.add_points)
             self.runningFlag = True
-            while i < self.end_val:
-                QtCore.QTimer.singleShot((1000 // self.speed.value())-10, self.loop.quit)
-                self.loop.exec_()
-                if self.pauseFlag:
-                    break
-                x, y, ver = m.Fractal(self.posit.x(), self.posit.y(), self.vertexes,
-                                      allowed_vertexes, relation).coordinates()
-                self.posit = QtCore.QPoint(x, y)
-                self.color = ver.color
-                self.update()
-                if self.spinBox.endless:
-                    self.spinBox.setValue(self.spinBox.value() + 1)
-                else:
-                    self.spinBox.setValue(self.spinBox.value() - 1)
-                    i += 1
+            self.worker.start()
+
+    def add_points(self, chunk):
+        """Add points
+
+        Receives a chunk of points from the worker thread. When the run is set to go until converged, it is paused
+        as soon as the picture stops changing.
+
+        :param chunk: arrays of x coords, y coords and chosen vertexes
+        """
+        worker = self.sender()
+        if isinstance(worker, Worker):
+            worker.taken()
+        if self.density is None:
+            return
+        xs, ys, vers = chunk
+        self.density.add(xs, ys, vers)
+        self.posit = QtCore.QPoint(int(round(xs[-1])), int(round(ys[-1])))
+        self.dirty = True
+        self.update()
+        self.stats_label.setText(str(self.density.stats))
+        if self.convergence is not None:
+            if self.convergence.update(len(xs)):
+                self.pause()
+            self.stats_label.setText('{} | {}'.format(self.density.stats, self.convergence))
+        # an endless run is counted in stats_label, the spinBox would stop at its maximum
+        if not self.spinBox.endless:
+            self.spinBox.setValue(self.spinBox.value() - len(xs))
 
     def mousePressEvent(self, e):
         if self.runningFlag or \
@@ -304,15 +447,35 @@ class GUI(QtWidgets.QMainWindow):
         self.stop()
         self.close()
 
+    def recolor(self):
+        """Repaint the points with the current dot colors"""
+        if self.density is not None:
+            self.dirty = True
+            self.update()
+
+    def density_image(self):
+        """Density image
+
+        Converts the whole density buffer to an image in one pass, coloured by the current dot colors. While there are
+        few points a coarser level of the buffer is shown, so the shape appears right away and sharpens as points come.
+
+        :return: QImage with transparent background
+        """
+        colors = [self.vertexes[i].color.getRgb()[:3] for i in sorted(self.vertexes)]
+        self.frame = self.density.preview(colors, alpha=True)
+        height, width = self.frame.shape[:2]
+        return QtGui.QImage(self.frame.data, width, height, 4 * width, QtGui.QImage.Format_RGBA8888)
+
     def paintEvent(self, ev):
-        qp = QtGui.QPainter(self.oImage)
-        qp.setRenderHint(QtGui.QPainter.Antialiasing)
-        if self.color:
-            pen = QtGui.QPen(self.color)
-            qp.setPen(pen)
-            qp.drawPoint(self.posit)
-            self.plt.setBrush(self.plt.Window, QtGui.QBrush(self.oImage))
-            self.setPalette(self.plt)
+        if self.dirty:
+            self.dirty = False
+            with self.density.stats.timer('repaint'):
+                board = QtGui.QImage(self.oImage)
+                qp = QtGui.QPainter(board)
+                qp.drawImage(0, 0, self.density_image())
+                qp.end()
+                self.plt.setBrush(self.plt.Window, QtGui.QBrush(board))
+                self.setPalette(self.plt)
         self.ver_label.setText("Vertices: {}".format(len(self.vertexes.keys())))
         self.ver_label.setStyleSheet("""color: red;
                                      font: 10pt "Verdana";""")
@@ -333,8 +496,7 @@ class GUI(QtWidgets.QMainWindow):
                     t2 = self.lineEdit_2.text().split(':')
                     try:
                         t2 = list(map(lambda x: 0 < int(x), t2))
-                        if not ((all(map(lambda x: 0 <= int(x) < 6, t1))
-                                or all(t2)) and len(t2) == 2):
+                        if not (all(map(lambda x: 0 <= int(x) < 6, t1)) and all(t2) and len(t2) == 2):
                             return
                         else:
                             self.textEdit_2.hide()
@@ -355,7 +517,20 @@ class GUI(QtWidgets.QMainWindow):
                                                font: 10pt "Verdana";""")
 
 
-if __name__ == '__main__':
-    app = QtWidgets.QApplication(sys.argv)
+def main(argv=None):
+    """Run the application
+
+    :param argv: command line, sys.argv by default. "--compile-ui" writes the precompiled UI module and exits
+    """
+    argv = sys.argv if argv is None else argv
+    if '--compile-ui' in argv[1:]:
+        compile_ui()
+        return 0
+    set_app_id()
+    app = QtWidgets.QApplication(argv)
     window = GUI()
-    sys.exit(app.exec_())
+    return app.exec_()
+
+
+if __name__ == '__main__':
+    sys.exit(main())